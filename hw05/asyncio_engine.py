@@ -0,0 +1,231 @@
+import asyncio
+import concurrent.futures
+import time
+
+import http_timers
+import lib_for_http_server as lib_helper
+from http_log import log, access_log
+from http_metrics import metrics
+
+
+class HTTPProtocol(asyncio.Protocol):
+    """asyncio engine: drives an HTTPConnection over a transport.
+
+    Everything HTTP specific lives in HTTPConnection and
+    HTTPRequestProcessor, shared with the selector engine, this class only
+    moves bytes and applies flow control.
+    """
+
+    def __init__(self, server, submit=None):
+        self.server = server
+        # Runs blocking file-system calls in the I/O thread pool
+        self.submit = submit
+        self.loop = asyncio.get_running_loop()
+        self.transport = None
+        self.addr = None
+        self.connection = None
+        self._writer = None
+        self._reading_paused = False
+        self._can_write = asyncio.Event()
+        self._can_write.set()
+        self._sending_file = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+        log.debug('accepted connection from %s', self.addr)
+        self.connection = self.server.new_connection(self.submit, self.addr)
+        self.connection.on_response_ready = self._process_requests
+        self.connection.on_timeout = self._timed_out
+
+    def data_received(self, data):
+        self.connection.feed(data)
+        self._process_requests()
+
+    def eof_received(self):
+        self.connection.eof()
+        self._process_requests()
+        # Keep the transport open to finish the queued responses
+        return True
+
+    def connection_lost(self, exc):
+        log.debug('closing connection to %s', self.addr)
+        if self._writer is not None:
+            self._writer.cancel()
+        self._can_write.set()
+        self.connection.close()
+
+    def pause_writing(self):
+        self._can_write.clear()
+
+    def resume_writing(self):
+        self._can_write.set()
+
+    def _process_requests(self):
+        if self.transport.is_closing():
+            return
+        self.connection.process_requests()
+        if self.connection.finished:
+            self.transport.close()
+            return
+        reading = self.connection.reading_allowed
+        if reading and self._reading_paused:
+            self.transport.resume_reading()
+        elif not reading and not self._reading_paused:
+            self.transport.pause_reading()
+        self._reading_paused = not reading
+        if self.connection.responses and self._writer is None:
+            self._writer = self.loop.create_task(self._send_responses())
+
+    async def _send_responses(self):
+        responses = self.connection.responses
+        try:
+            while responses:
+                response = responses[0]
+                if not response.ready:
+                    # _process_requests starts a new writer when it is
+                    return
+                if response.segments:
+                    # A single sendmsg() since Python 3.12, joined before
+                    self.transport.writelines(response.segments)
+                    response.segments.clear()
+                await self._send_body(response.body)
+                await self._can_write.wait()
+                self.connection.sent(time.monotonic())
+                if not self.connection.finish_response():
+                    self.transport.close()
+                    return
+                # Freed queue slots let buffered pipelined requests in
+                self._process_requests()
+        finally:
+            self._writer = None
+
+    async def _send_body(self, body):
+        if isinstance(body, lib_helper.FileBody):
+            # Waits until the headers are flushed, then uses os.sendfile
+            self._sending_file = True
+            try:
+                await self.loop.sendfile(self.transport, body.file, body.offset, body.remaining)
+            finally:
+                self._sending_file = False
+            body.offset += body.remaining
+            body.remaining = 0
+        elif body is not None:
+            while not body.done:
+                chunk = body.pull()
+                if chunk:
+                    self.transport.write(chunk)
+                await self._can_write.wait()
+                self.connection.sent(time.monotonic())
+
+    def _timed_out(self):
+        if self._sending_file and self.connection.deadline_kind == http_timers.SEND:
+            # Progress of loop.sendfile() can't be observed, it ends on its own
+            # or with the connection
+            self.connection.rearm(time.monotonic())
+            return
+        # Unsent data of a client that stopped reading is dropped
+        self.transport.abort()
+
+
+class Acceptor:
+    """Accepts connections with the server's accept_connections(), in
+    batches and within its connection limit. asyncio.Server can't stop
+    accepting while the limit is reached."""
+
+    def __init__(self, server, protocol_factory):
+        self.server = server
+        self.protocol_factory = protocol_factory
+        self.loop = asyncio.get_running_loop()
+        self.lsock = server.lsock
+        server.connection_limit.on_pause = self.pause
+
+    def start(self):
+        self.loop.add_reader(self.lsock, self._accept)
+
+    def stop(self):
+        self.loop.remove_reader(self.lsock)
+
+    def pause(self, paused):
+        if paused:
+            self.stop()
+        else:
+            self.start()
+
+    def _accept(self):
+        for conn, addr in self.server.accept_connections(self.lsock):
+            conn.setblocking(False)
+            task = self.loop.create_task(
+                self.loop.connect_accepted_socket(self.protocol_factory, conn))
+            task.add_done_callback(lambda task, conn=conn: self._connected(task, conn))
+
+    def _connected(self, task, conn):
+        if task.cancelled() or task.exception() is not None:
+            # The protocol never saw the connection, HTTPConnection.close() won't count it
+            if not task.cancelled():
+                log.error('can not set up connection: %r', task.exception())
+            conn.close()
+            self.server.connection_limit.closed()
+
+
+async def _watch_stalls(monitor, interval=0.1):
+    """Lateness of a periodic heartbeat is the time the loop was busy."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lateness = max(loop.time() - started - interval, 0.0)
+        monitor.record(lateness)
+        metrics.observe_loop(lateness)
+
+
+async def _expire_deadlines(timers, connection_limit):
+    while True:
+        await asyncio.sleep(timers.resolution)
+        now = time.monotonic()
+        for connection in timers.expire(now):
+            connection.expire(now)
+        if connection_limit.paused:
+            connection_limit.check(now)
+
+
+async def _tick(date):
+    """Refresh the cached Date header right after each second starts, hand
+    the collected access records to the log writer, publish the metrics."""
+    while True:
+        date.refresh()
+        now = time.monotonic()
+        access_log.flush_if_due(now)
+        metrics.publish_if_due(now)
+        await asyncio.sleep(1.0 - time.time() % 1.0)
+
+
+async def _serve(server):
+    loop = asyncio.get_running_loop()
+    submit = None
+    if server.io_threads > 0:
+        executor = concurrent.futures.ThreadPoolExecutor(
+            server.io_threads, thread_name_prefix="file-io")
+        loop.set_default_executor(executor)
+
+        def submit(fn, args, callback):
+            loop.run_in_executor(executor, fn, *args).add_done_callback(callback)
+    stall_watcher = loop.create_task(_watch_stalls(server.stall_monitor))
+    ticker = loop.create_task(_tick(server.request_processor.date))
+    deadlines = loop.create_task(_expire_deadlines(server.timers, server.connection_limit))
+    acceptor = Acceptor(server, lambda: HTTPProtocol(server, submit))
+    acceptor.start()
+    try:
+        # Until cancelled by KeyboardInterrupt
+        await loop.create_future()
+    finally:
+        if not server.connection_limit.paused:
+            acceptor.stop()
+        stall_watcher.cancel()
+        ticker.cancel()
+        deadlines.cancel()
+
+
+def serve(server):
+    """Run the asyncio engine on server.lsock in the current worker."""
+    asyncio.run(_serve(server))
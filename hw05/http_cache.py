@@ -0,0 +1,172 @@
+import os
+import collections
+
+
+class CachedFile:
+    __slots__ = ("path", "body", "content_type", "mtime", "source_size", "size", "checked",
+                 "etag", "last_modified", "encoding")
+
+    def __init__(self, path, body, content_type, mtime, source_size, checked,
+                 etag=None, last_modified=None, encoding=None):
+        self.path = path
+        self.body = body
+        self.content_type = content_type
+        # mtime and size of the file at path, body may be its gzip variant
+        self.mtime = mtime
+        self.source_size = source_size
+        self.size = len(body)
+        # monotonic time of the last os.stat freshness check
+        self.checked = checked
+        self.etag = etag
+        self.last_modified = last_modified
+        self.encoding = encoding
+
+
+class LRUFileCache:
+    """Size-bounded LRU cache of small static files kept in memory.
+
+    Entries are revalidated with os.stat (mtime and size) at most once per
+    revalidate_after seconds, a hit in between makes no system calls.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_file_size=1024 * 1024,
+                 revalidate_after=1.0):
+        self.max_bytes = max_bytes
+        self.max_file_size = min(max_file_size, max_bytes)
+        self.revalidate_after = revalidate_after
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, now):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if now - entry.checked >= self.revalidate_after:
+            if not self._is_fresh(entry):
+                self._remove(key)
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            entry.checked = now
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    @staticmethod
+    def _is_fresh(entry):
+        try:
+            stat = os.stat(entry.path)
+        except OSError:
+            return False
+        return stat.st_mtime_ns == entry.mtime and stat.st_size == entry.source_size
+
+    def add(self, key, path, body, content_type, stat, now, etag=None, last_modified=None,
+            encoding=None):
+        """Cache body read from path, stat is taken before reading it."""
+        entry = CachedFile(path, body, content_type, stat.st_mtime_ns, stat.st_size, now,
+                           etag, last_modified, encoding)
+        if entry.size <= self.max_file_size:
+            self.put(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = entry
+        self.size += entry.size
+        while self.size > self.max_bytes:
+            evicted_key = next(iter(self.entries))
+            self._remove(evicted_key)
+            self.evictions += 1
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.size -= entry.size
+
+    def stats(self):
+        return dict(entries=len(self.entries), bytes=self.size, hits=self.hits,
+                    misses=self.misses, evictions=self.evictions,
+                    invalidations=self.invalidations)
+
+
+class ResolvedPath:
+    """What a request target resolved to: a regular file with its stat,
+    content type and validators, or the error status it got."""
+    __slots__ = ("responsecode", "path", "stat", "content_type", "encoding", "variant",
+                 "validators", "cache_key", "expires")
+
+    def __init__(self, responsecode=None, path=None, stat=None, content_type=None,
+                 encoding=None, variant=None, validators=None, cache_key=None):
+        # "403" or "404", None for a file
+        self.responsecode = responsecode
+        self.path = path
+        self.stat = stat
+        self.content_type = content_type
+        # "gzip" with the os.stat of the path.gz variant, or with variant None
+        # when the file is compressed into the GzipCache
+        self.encoding = encoding
+        self.variant = variant
+        # ETag and Last-Modified
+        self.validators = validators
+        # Key of the file in the LRUFileCache
+        self.cache_key = cache_key
+        # monotonic time the entry stops being trusted
+        self.expires = 0.0
+
+
+class PathCache:
+    """Bounded LRU cache of resolved request targets, 403 and 404 decisions
+    included, so a scanner asking for the same missing file again costs no
+    system calls.
+
+    An entry is trusted for ttl seconds, then the target is resolved again:
+    a file created, changed or removed in between is noticed that late.
+    """
+
+    def __init__(self, max_entries=10000, ttl=1.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def get(self, key, now):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if now >= entry.expires:
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        if entry.responsecode is None:
+            self.hits += 1
+        else:
+            self.negative_hits += 1
+        return entry
+
+    def put(self, key, entry, now):
+        entry.expires = now + self.ttl
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.negative_hits + self.misses
+        hit_rate = (self.hits + self.negative_hits) / lookups if lookups else 0.0
+        return dict(entries=len(self.entries), hits=self.hits,
+                    negative_hits=self.negative_hits, misses=self.misses,
+                    hit_rate=round(hit_rate, 3), expirations=self.expirations,
+                    evictions=self.evictions)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""gzip content coding of static files.
+
+Variants are written next to the files ahead of time, as file.gz, by
+precompress() - at server start with --gzip-precompress or offline with
+python http_gzip.py <doc_root>. Files without a fresh variant are
+compressed on the fly into a bounded GzipCache.
+"""
+
+import argparse
+import collections
+import gzip
+import mimetypes
+import os
+import threading
+from stat import S_ISREG
+
+
+SUFFIX = ".gz"
+# Smaller bodies barely shrink, the gzip header alone takes 20 bytes
+MIN_SIZE = 256
+# Besides text/*, images and archives are compressed already
+COMPRESSIBLE_TYPES = frozenset([
+    "application/javascript",
+    "application/x-javascript",
+    "application/json",
+    "application/xml",
+    "application/xhtml+xml",
+    "image/svg+xml",
+])
+
+
+def compressible(content_type, size):
+    if size < MIN_SIZE or content_type is None:
+        return False
+    return content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES
+
+
+def accepts_gzip(accept_encoding):
+    """True if an Accept-Encoding value allows gzip (RFC 7231 5.3.4)."""
+    if not accept_encoding:
+        return False
+    qvalues = {}
+    for coding in accept_encoding.lower().split(","):
+        name, _, params = coding.partition(";")
+        qvalue = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                qvalue = float(params[2:])
+            except ValueError:
+                qvalue = 0.0
+        qvalues[name.strip()] = qvalue
+    qvalue = qvalues.get("gzip", qvalues.get("x-gzip", qvalues.get("*", 0.0)))
+    return qvalue > 0
+
+
+def fresh_variant(path, stat):
+    """os.stat of path.gz if it is at least as new as the file, else None."""
+    try:
+        variant = os.stat(path + SUFFIX)
+    except OSError:
+        return None
+    if not S_ISREG(variant.st_mode) or variant.st_mtime_ns < stat.st_mtime_ns:
+        return None
+    return variant
+
+
+def precompress(rootdir, level=9):
+    """Write path.gz for every compressible file under rootdir without a
+    fresh one, returns the number of variants written."""
+    written = 0
+    for dirpath, _, filenames in os.walk(rootdir):
+        for name in filenames:
+            if name.endswith(SUFFIX):
+                continue
+            path = os.path.join(dirpath, name)
+            stat = os.stat(path)
+            if not compressible(mimetypes.guess_type(path)[0], stat.st_size):
+                continue
+            if fresh_variant(path, stat) is not None:
+                continue
+            with open(path, "rb") as source:
+                data = gzip.compress(source.read(), level, mtime=0)
+            temp_path = path + SUFFIX + ".tmp"
+            with open(temp_path, "wb") as variant:
+                variant.write(data)
+            # Same mtime as the file: a later change of the file makes it stale
+            os.utime(temp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            os.replace(temp_path, path + SUFFIX)
+            written += 1
+    return written
+
+
+class GzipCache:
+    """Size-bounded LRU cache of bodies compressed on the fly.
+
+    Keys include the ETag of the file, so a changed file is compressed
+    again and a hit needs no system call. Used from the I/O threads,
+    every access holds the lock.
+    """
+
+    def __init__(self, max_bytes=8 * 1024 * 1024, max_file_size=1024 * 1024, level=6):
+        self.max_bytes = max_bytes
+        # Larger files are sent without compression
+        self.max_file_size = max_file_size
+        self.level = level
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def compress(self, path, etag):
+        key = (path, etag)
+        with self.lock:
+            body = self.entries.get(key)
+            if body is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return body
+            self.misses += 1
+        with open(path, "rb") as source:
+            body = gzip.compress(source.read(), self.level, mtime=0)
+        with self.lock:
+            if key not in self.entries and len(body) <= self.max_bytes:
+                self.entries[key] = body
+                self.size += len(body)
+                while self.size > self.max_bytes:
+                    _, evicted = self.entries.popitem(last=False)
+                    self.size -= len(evicted)
+                    self.evictions += 1
+        return body
+
+    def stats(self):
+        with self.lock:
+            return dict(entries=len(self.entries), bytes=self.size, hits=self.hits,
+                        misses=self.misses, evictions=self.evictions)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Write gzip variants of static files')
+    parser.add_argument('root', help='DIRECTORY_ROOT with site files')
+    parser.add_argument(
+        '-l', '--level', type=int, default=9,
+        help='compression level, default - 9'
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(f'{precompress(args.root, args.level)} gzip variants written')
@@ -0,0 +1,262 @@
+import logging
+import os
+import queue
+import re
+import sys
+import threading
+import time
+
+
+LEVELS = ("debug", "info", "warning", "error")
+
+# Server events, debug messages trace every connection and response
+log = logging.getLogger("otuserver")
+
+_STOP = object()
+_REOPEN = object()
+
+
+class Formatter(logging.Formatter):
+    """Formats the date and time of records once per second."""
+
+    def __init__(self, fmt=None):
+        super().__init__(fmt)
+        self._second = None
+        self._time = None
+
+    def formatTime(self, record, datefmt=None):
+        second = int(record.created)
+        if second != self._second:
+            self._time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+            self._second = second
+        return f'{self._time},{int(record.msecs):03d}'
+
+
+class BufferedLogHandler(logging.Handler):
+    """Hands records to a writer thread that formats and writes them in
+    batches, when buffer_size records are waiting or flush_interval
+    seconds after the first of them. The event loop only puts a record on
+    a queue, it never waits for a slow stdout or disk.
+    """
+
+    def __init__(self, stream=None, buffer_size=256, flush_interval=1.0, filename=None):
+        super().__init__()
+        # Written to filename if given, reopened on reopen()
+        self.filename = filename
+        if filename is not None:
+            stream = open(filename, "a")
+        self.stream = stream or sys.stderr
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.queue = None
+        self.thread = None
+        self._start()
+        # The thread doesn't survive fork, every worker starts its own
+        os.register_at_fork(after_in_child=self._start)
+
+    def _start(self):
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._write_batches, name="log-writer",
+                                       daemon=True)
+        self.thread.start()
+
+    def emit(self, record):
+        self.queue.put(record)
+
+    def reopen(self):
+        """Reopen the file after logrotate moved it, safe in signal handlers."""
+        self.queue.put(_REOPEN)
+
+    def put_batch(self, format_batch, records):
+        """Queue records that are not LogRecords, format_batch turns them
+        into lines in the writer thread."""
+        self.queue.put((format_batch, records))
+
+    def _write_batches(self):
+        lines = []
+        deadline = None
+        while True:
+            timeout = None if not lines else max(deadline - time.monotonic(), 0.0)
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                self._write(lines)
+                return
+            if item is _REOPEN:
+                self._write(lines)
+                lines.clear()
+                deadline = None
+                self._reopen()
+                continue
+            if isinstance(item, tuple):
+                # Collected by the caller already, written right away
+                format_batch, records = item
+                lines.extend(format_batch(records))
+            elif item is not None:
+                try:
+                    lines.append(self.format(item))
+                except Exception:
+                    self.handleError(item)
+            if isinstance(item, logging.LogRecord):
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                if len(lines) < self.buffer_size and time.monotonic() < deadline:
+                    continue
+            self._write(lines)
+            lines.clear()
+            deadline = None
+
+    def _write(self, lines):
+        if not lines:
+            return
+        try:
+            self.stream.write("\n".join(lines) + "\n")
+            self.stream.flush()
+        except Exception:
+            pass
+
+    def _reopen(self):
+        if self.filename is None:
+            return
+        try:
+            stream = open(self.filename, "a")
+        except OSError as e:
+            log.error('can not reopen %s: %r', self.filename, e)
+            return
+        self.stream.close()
+        self.stream = stream
+
+    def close(self):
+        """Write out the waiting records."""
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join()
+        if self.filename is not None:
+            self.stream.close()
+        super().close()
+
+
+_UNSAFE = re.compile(r'["\\\x00-\x1f\x7f-\xff]')
+
+
+def _escape_char(match):
+    char = match.group()
+    if char == '"' or char == "\\":
+        return "\\" + char
+    return "\\x%02x" % ord(char)
+
+
+def _escape(value):
+    """Escape a value logged between quotes the way Apache does: quotes and
+    backslashes with a backslash, control and non-ASCII octets as \\xHH, so
+    a client can't end the line and forge the next one."""
+    if _UNSAFE.search(value) is None:
+        return value
+    return _UNSAFE.sub(_escape_char, value)
+
+
+class AccessLog:
+    """One record per response, kept as a tuple by the event loop.
+
+    A LogRecord costs microseconds, so records are collected in a list and
+    handed to the writer thread of a BufferedLogHandler a batch at a time:
+    when buffer_size of them are waiting, or on flush_if_due() called by
+    the event loop once flush_interval seconds passed. Lines are in the
+    Common or Combined Log Format followed by the response time in seconds.
+    """
+
+    formats = ("common", "combined")
+
+    def __init__(self, buffer_size=256, flush_interval=1.0, log_format="combined"):
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.combined = log_format == "combined"
+        # None - the access log is off
+        self.handler = None
+        # The handler writes a file of this worker, closed with the log
+        self.owns_handler = False
+        self.records = []
+        self.flushed = time.monotonic()
+
+    def open(self, filename):
+        self.close()
+        self.handler = BufferedLogHandler(buffer_size=self.buffer_size,
+                                          flush_interval=self.flush_interval,
+                                          filename=filename)
+        self.owns_handler = True
+
+    def reopen(self):
+        """Called from the SIGUSR1 handler, the collected records still go
+        to the old file."""
+        if self.owns_handler:
+            self.flush()
+            self.handler.reopen()
+
+    def write(self, remote_addr, request, responsecode, body_length, duration):
+        if self.handler is None:
+            return
+        self.records.append((time.time(), remote_addr, request, responsecode, body_length,
+                             duration))
+        if len(self.records) >= self.buffer_size:
+            self.flush()
+
+    def flush_if_due(self, now):
+        if self.records and now - self.flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.flushed = time.monotonic()
+        if self.records:
+            records, self.records = self.records, []
+            self.handler.put_batch(self.format_batch, records)
+
+    def close(self):
+        if self.handler is None:
+            return
+        self.flush()
+        if self.owns_handler:
+            self.handler.close()
+        self.handler = None
+        self.owns_handler = False
+
+    def format_batch(self, records):
+        second = None
+        for created, remote_addr, request, responsecode, body_length, duration in records:
+            if int(created) != second:
+                second = int(created)
+                date = time.strftime("%d/%b/%Y:%H:%M:%S %z", time.localtime(second))
+            host = remote_addr[0] if remote_addr else "-"
+            # An unparsable request has no request line
+            headers = getattr(request, "headers", None)
+            request_line = "-" if headers is None else _escape(str(request))
+            line = (f'{host} - - [{date}] "{request_line}" {responsecode} '
+                    f'{body_length or "-"}')
+            if self.combined:
+                if headers is None:
+                    headers = {}
+                line = (f'{line} "{_escape(headers.get("referer", "-"))}" '
+                        f'"{_escape(headers.get("user-agent", "-"))}"')
+            yield f'{line} {duration:.3f}'
+
+
+access_log = AccessLog()
+
+
+def setup_logging(level="info", access=True, access_format="combined", stream=None):
+    # Skip the record attributes that aren't logged, finding the caller
+    # costs more than the rest of a record
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logMultiprocessing = False
+    handler = BufferedLogHandler(stream)
+    handler.setFormatter(Formatter("%(asctime)s [%(process)d] %(levelname)s %(message)s"))
+    log.addHandler(handler)
+    log.setLevel(level.upper())
+    log.propagate = False
+    if access:
+        # Until a worker opens its own access log file
+        access_log.handler = handler
+        access_log.combined = access_format == "combined"
+    return handler
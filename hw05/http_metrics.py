@@ -0,0 +1,215 @@
+"""Server metrics in the Prometheus text format.
+
+Every worker counts into a plain list, recording a response takes a few
+list updates and a bisect. The list is copied into the slot of the worker
+in a shared RawArray about once a second and right before a scrape, so a
+scrape served by any worker sums the slots of all of them, the others at
+most a second late.
+"""
+
+import multiprocessing
+from bisect import bisect_left
+
+from http_timers import DEADLINES
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds of the histogram buckets, the last bucket is +Inf
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1.0, 2.5, 5.0, 10.0)
+LOOP_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                0.25, 1.0)
+FS_CALL_BUCKETS = (0, 1, 2, 3, 4, 6, 8)
+# Estimated from the request duration histogram
+QUANTILES = (0.5, 0.9, 0.99)
+
+# Offsets in the values of a worker, the requests by status come last
+BYTES_SENT = 0
+CONNECTIONS_OPENED = 1
+CONNECTIONS_CLOSED = 2
+DURATION = 3
+DURATION_SUM = DURATION + len(DURATION_BUCKETS) + 1
+LOOP = DURATION_SUM + 1
+LOOP_SUM = LOOP + len(LOOP_BUCKETS) + 1
+FS_CALLS = LOOP_SUM + 1
+FS_CALLS_SUM = FS_CALLS + len(FS_CALL_BUCKETS) + 1
+TIMED_OUT = FS_CALLS_SUM + 1
+REQUESTS = TIMED_OUT + len(DEADLINES)
+
+
+def _bucket_lines(name, bounds, counts, total):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(bounds + ("+Inf",), counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative:.0f}')
+    lines.append(f'{name}_sum {total:.9g}')
+    lines.append(f'{name}_count {cumulative:.0f}')
+    return lines
+
+
+def estimate_quantile(quantile, bounds, counts):
+    """Linear interpolation inside the bucket, like histogram_quantile()."""
+    total = sum(counts)
+    if not total:
+        return float("nan")
+    rank = quantile * total
+    cumulative = 0
+    lower = 0.0
+    for bound, count in zip(bounds, counts):
+        if count and cumulative + count >= rank:
+            return lower + (bound - lower) * (rank - cumulative) / count
+        cumulative += count
+        lower = bound
+    # In the +Inf bucket: the largest finite bound is the best guess
+    return bounds[-1]
+
+
+class Metrics:
+    """Counters and histograms of the workers of one server.
+
+    setup() in the master allocates the shared memory before the workers
+    are forked, attach() in a worker starts recording. Until then the
+    observe methods return at once.
+    """
+
+    def __init__(self, publish_interval=1.0):
+        self.publish_interval = publish_interval
+        self.published = 0.0
+        self.codes = ()
+        self.status_index = {}
+        self.size = 0
+        self.workers = 0
+        self.shared = None
+        self.worker_id = None
+        # Values of this worker, None - not recording
+        self.values = None
+
+    def setup(self, workers, codes):
+        self.codes = tuple(sorted(codes))
+        self.status_index = {code: REQUESTS + i for i, code in enumerate(self.codes)}
+        # One more slot for codes the server doesn't know
+        self.size = REQUESTS + len(self.codes) + 1
+        self.workers = workers
+        self.shared = multiprocessing.RawArray('d', workers * self.size)
+
+    def attach(self, worker_id):
+        """Continue the counters a previous worker with this id left."""
+        if self.shared is None:
+            return
+        self.worker_id = worker_id
+        start = worker_id * self.size
+        values = self.shared[start:start + self.size]
+        # Its connections are gone with it
+        values[CONNECTIONS_CLOSED] = values[CONNECTIONS_OPENED]
+        self.values = values
+
+    def connection_opened(self):
+        if self.values is not None:
+            self.values[CONNECTIONS_OPENED] += 1
+
+    def connection_closed(self):
+        if self.values is not None:
+            self.values[CONNECTIONS_CLOSED] += 1
+
+    def connection_timed_out(self, kind):
+        if self.values is not None:
+            self.values[TIMED_OUT + DEADLINES.index(kind)] += 1
+
+    def observe_response(self, responsecode, sent, duration, fs_calls):
+        """sent - bytes of the head and body, duration - seconds since the
+        request was parsed, fs_calls - os.stat and open calls it took."""
+        values = self.values
+        if values is None:
+            return
+        values[self.status_index.get(responsecode, self.size - 1)] += 1
+        values[BYTES_SENT] += sent
+        values[DURATION + bisect_left(DURATION_BUCKETS, duration)] += 1
+        values[DURATION_SUM] += duration
+        values[FS_CALLS + bisect_left(FS_CALL_BUCKETS, fs_calls)] += 1
+        values[FS_CALLS_SUM] += fs_calls
+
+    def observe_loop(self, duration):
+        values = self.values
+        if values is None:
+            return
+        values[LOOP + bisect_left(LOOP_BUCKETS, duration)] += 1
+        values[LOOP_SUM] += duration
+
+    def publish_if_due(self, now):
+        if self.values is not None and now - self.published >= self.publish_interval:
+            self.published = now
+            self.publish()
+
+    def publish(self):
+        start = self.worker_id * self.size
+        self.shared[start:start + self.size] = self.values
+
+    def render(self):
+        self.publish()
+        per_worker = [self.shared[start:start + self.size]
+                      for start in range(0, self.workers * self.size, self.size)]
+        totals = [sum(column) for column in zip(*per_worker)]
+        lines = [
+            '# HELP otuserver_requests_total Responses sent, by status code.',
+            '# TYPE otuserver_requests_total counter',
+        ]
+        for code, index in self.status_index.items():
+            lines.append(f'otuserver_requests_total{{code="{code}"}} {totals[index]:.0f}')
+        lines.append(f'otuserver_requests_total{{code="other"}} {totals[-1]:.0f}')
+        lines += [
+            '# HELP otuserver_sent_bytes_total Bytes of response heads and bodies sent.',
+            '# TYPE otuserver_sent_bytes_total counter',
+            f'otuserver_sent_bytes_total {totals[BYTES_SENT]:.0f}',
+            '# HELP otuserver_connections_accepted_total Connections accepted, by worker.',
+            '# TYPE otuserver_connections_accepted_total counter',
+        ]
+        for worker_id, values in enumerate(per_worker):
+            lines.append(f'otuserver_connections_accepted_total{{worker="{worker_id}"}} '
+                         f'{values[CONNECTIONS_OPENED]:.0f}')
+        open_connections = totals[CONNECTIONS_OPENED] - totals[CONNECTIONS_CLOSED]
+        lines += [
+            '# HELP otuserver_connections_open Client connections open now.',
+            '# TYPE otuserver_connections_open gauge',
+            f'otuserver_connections_open {open_connections:.0f}',
+            '# HELP otuserver_connections_timed_out_total Connections closed by a missed '
+            'deadline: request head, send progress or keep-alive idle.',
+            '# TYPE otuserver_connections_timed_out_total counter',
+        ]
+        for i, kind in enumerate(DEADLINES):
+            lines.append(f'otuserver_connections_timed_out_total{{deadline="{kind}"}} '
+                         f'{totals[TIMED_OUT + i]:.0f}')
+        lines += [
+            '# HELP otuserver_request_duration_seconds Time from parsing a request to '
+            'sending the last byte of its response.',
+            '# TYPE otuserver_request_duration_seconds histogram',
+        ]
+        counts = totals[DURATION:DURATION_SUM]
+        lines += _bucket_lines('otuserver_request_duration_seconds', DURATION_BUCKETS, counts,
+                               totals[DURATION_SUM])
+        lines += [
+            '# HELP otuserver_request_duration_quantile_seconds Request duration quantiles '
+            'estimated from the histogram.',
+            '# TYPE otuserver_request_duration_quantile_seconds gauge',
+        ]
+        for quantile in QUANTILES:
+            lines.append(f'otuserver_request_duration_quantile_seconds{{quantile="{quantile}"}} '
+                         f'{estimate_quantile(quantile, DURATION_BUCKETS, counts):.6g}')
+        lines += [
+            '# HELP otuserver_loop_iteration_seconds Busy time of a selector loop iteration, '
+            'lateness of a 100 ms heartbeat with asyncio.',
+            '# TYPE otuserver_loop_iteration_seconds histogram',
+        ]
+        lines += _bucket_lines('otuserver_loop_iteration_seconds', LOOP_BUCKETS,
+                               totals[LOOP:LOOP_SUM], totals[LOOP_SUM])
+        lines += [
+            '# HELP otuserver_fs_calls_per_request os.stat and open calls made for a request.',
+            '# TYPE otuserver_fs_calls_per_request histogram',
+        ]
+        lines += _bucket_lines('otuserver_fs_calls_per_request', FS_CALL_BUCKETS,
+                               totals[FS_CALLS:FS_CALLS_SUM], totals[FS_CALLS_SUM])
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
@@ -0,0 +1,177 @@
+import re
+
+
+class HTTPParseError(Exception):
+    """Request can't be parsed, responsecode is the status to answer with."""
+
+    def __init__(self, responsecode, reason):
+        super().__init__(reason)
+        self.responsecode = responsecode
+
+
+# Control characters, only CR LF between lines and HTAB in values are allowed
+_CTL = bytes(range(9)) + bytes(range(10, 32)) + b"\x7f"
+_TOKEN = r"[!#$%&'*+\-.^_`|~0-9A-Za-z]+"
+# Tokens that needn't be matched against _TOKEN
+_METHODS = frozenset(("GET", "HEAD", "POST", "PUT", "DELETE", "OPTIONS"))
+
+
+def parse_fields(fields):
+    """Header lines checked by RequestParser to a dict."""
+    lines = fields.decode("latin-1").split("\r\n")
+    headers = {}
+    for line in lines:
+        name, _, value = line.partition(":")
+        headers[name.lower()] = value.strip(" \t")
+    if len(headers) == len(lines):
+        return headers
+    # Repeated fields
+    headers = {}
+    for line in lines:
+        name, _, value = line.partition(":")
+        name = name.lower()
+        value = value.strip(" \t")
+        if name in headers:
+            value = f'{headers[name]}, {value}'
+        headers[name] = value
+    return headers
+
+
+class Request:
+    __slots__ = ("method", "target", "version", "_headers", "_fields")
+
+    def __init__(self, method, target, version, headers=None, fields=b""):
+        self.method = method
+        self.target = target
+        self.version = version
+        self._headers = headers
+        # Header lines, parsed on first use of headers
+        self._fields = fields
+
+    @property
+    def headers(self):
+        """lower-cased field name -> value, repeated fields joined with ", "."""
+        if self._headers is None:
+            self._headers = parse_fields(self._fields) if self._fields else {}
+            self._fields = None
+        return self._headers
+
+    def header(self, name, default=None):
+        headers = self._headers
+        if headers is None:
+            headers = self.headers
+        return headers.get(name, default)
+
+    def keep_alive_requested(self):
+        """HTTP/1.1 connections are persistent unless the client sends
+        Connection: close, HTTP/1.0 ones only with Connection: keep-alive."""
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.1":
+            return "close" not in connection
+        return "keep-alive" in connection
+
+    def __str__(self):
+        return f'{self.method} {self.target} {self.version}'
+
+    def __repr__(self):
+        return f'Request({self})'
+
+
+class RequestParser:
+    """Incremental HTTP/1.x request parser working on bytes.
+
+    Data is fed as it arrives from the socket, next_request() returns a
+    Request once its whole header block is buffered and leaves the rest of
+    the buffer for the following (pipelined) request. The end of headers is
+    searched only in new data, so a head trickling in byte by byte is not
+    rescanned from the start each time.
+
+    The head is checked as a whole, its header lines are parsed only when
+    the request looks at them.
+    """
+
+    token = re.compile(_TOKEN)
+    # A header line not starting with a field name and a colon: whitespace
+    # around the name, obsolete line folding, no colon
+    bad_field = re.compile(rf"\n(?!{_TOKEN}:)".encode())
+    # The same or a field announcing a body, one scan of a common head
+    check_fields = re.compile(
+        rf"\n(?:(?!{_TOKEN}:)|(?i:content-length|transfer-encoding):)".encode())
+
+    def __init__(self, max_header_size=8192, max_headers=100):
+        self.max_header_size = max_header_size
+        self.max_headers = max_headers
+        self.buffer = bytearray()
+        self._scanned = 0
+        # body bytes of the previous request still to be discarded
+        self._skip = 0
+
+    def feed(self, data):
+        if self._skip:
+            skipped = min(self._skip, len(data))
+            self._skip -= skipped
+            data = data[skipped:]
+        self.buffer += data
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def next_request(self):
+        # Robust servers ignore empty lines before a request-line (RFC 7230 3.5),
+        # checked until the first two bytes are buffered
+        if self._scanned < 2:
+            while self.buffer.startswith(b"\r\n"):
+                del self.buffer[:2]
+                self._scanned = 0
+        scanned = self._scanned
+        end = self.buffer.find(b"\r\n\r\n", scanned - 3 if scanned > 3 else 0)
+        if end < 0:
+            self._scanned = len(self.buffer)
+            if self._scanned > self.max_header_size:
+                raise HTTPParseError("431", "request header block is too large")
+            return None
+        if end > self.max_header_size:
+            raise HTTPParseError("431", "request header block is too large")
+        head = self.buffer[:end]
+        del self.buffer[:end + 4]
+        self._scanned = 0
+        return self.parse_head(head)
+
+    def parse_head(self, head):
+        lines = head.count(b"\r\n")
+        # Every control character deleted is one of the line breaks, no bare
+        # CR or LF a proxy in front could split lines differently on
+        if len(head) - len(head.translate(None, _CTL)) != 2 * lines:
+            raise HTTPParseError("400", "control character in request head")
+        if lines > self.max_headers:
+            raise HTTPParseError("431", "too many header fields")
+        end = head.find(b"\r\n")
+        if end < 0:
+            end = len(head)
+        # Field values are opaque octets, latin-1 maps them one to one
+        parts = head[:end].decode("latin-1").split(" ")
+        if len(parts) != 3 or parts[0] not in _METHODS and not self.token.fullmatch(parts[0]):
+            raise HTTPParseError("400", "malformed request line")
+        method, target, version = parts
+        if not version.startswith("HTTP/1.") or not target:
+            raise HTTPParseError("400", "unsupported protocol version")
+        request = Request(method, target, version, None, head[end + 2:])
+        match = self.check_fields.search(head, end)
+        if match is not None:
+            if self.bad_field.search(head, match.start()) is not None:
+                raise HTTPParseError("400", "malformed header field")
+            self._discard_body(request)
+        return request
+
+    def _discard_body(self, request):
+        if "transfer-encoding" in request.headers:
+            raise HTTPParseError("400", "chunked request bodies are not supported")
+        length = request.headers.get("content-length")
+        if length is None:
+            return
+        if not length.isdigit():
+            raise HTTPParseError("400", "invalid Content-Length")
+        length = int(length)
+        buffered = min(length, len(self.buffer))
+        del self.buffer[:buffered]
+        self._skip = length - buffered
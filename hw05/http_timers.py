@@ -0,0 +1,100 @@
+import collections
+import time
+
+
+# Deadline kinds of a connection, see HTTPConnection.update_deadline
+HEADER = "header"
+SEND = "send"
+KEEPALIVE = "keepalive"
+DEADLINES = (HEADER, SEND, KEEPALIVE)
+
+
+class TimerWheel:
+    """Hashed timer wheel of connection deadlines.
+
+    An entry sits in the slot of the tick it is checked at, modulo the
+    number of slots, so scheduling and cancelling are a set operation and
+    expire() looks only at the slots of the ticks that passed instead of
+    at every connection.
+
+    An entry is checked at its deadline or max_delay seconds after the
+    previous check, whichever comes first. Its owner may then move the
+    deadline with a plain attribute store, without touching the wheel, as
+    long as the new deadline is at least max_delay seconds away.
+
+    Entries have deadline, deadline_kind and timer_tick attributes,
+    timer_tick None while the entry is not in the wheel. An expired entry
+    is out of the wheel, its owner schedules it again to keep it.
+    """
+
+    def __init__(self, resolution=0.25, size=512, max_delay=5.0, now=None):
+        # Deadlines expire up to resolution seconds late
+        self.resolution = resolution
+        self.max_delay = max_delay
+        self.slots = [set() for _ in range(size)]
+        # Last tick expire() processed
+        self.tick = self._tick(time.monotonic() if now is None else now)
+        self.count = 0
+        # Entries timed out by deadline_kind, see timed_out()
+        self.expired = collections.Counter()
+
+    def __len__(self):
+        return self.count
+
+    def _tick(self, when):
+        return int(when / self.resolution)
+
+    def schedule(self, entry, deadline, now=None):
+        entry.deadline = deadline
+        if now is not None:
+            deadline = min(deadline, now + self.max_delay)
+        tick = max(self._tick(deadline) + 1, self.tick + 1)
+        if entry.timer_tick is not None:
+            if entry.timer_tick <= tick:
+                # Checked early enough, moved then if still not due
+                return
+            self.slots[entry.timer_tick % len(self.slots)].discard(entry)
+        else:
+            self.count += 1
+        entry.timer_tick = tick
+        self.slots[tick % len(self.slots)].add(entry)
+
+    def cancel(self, entry):
+        if entry.timer_tick is not None:
+            self.slots[entry.timer_tick % len(self.slots)].discard(entry)
+            entry.timer_tick = None
+            self.count -= 1
+
+    def expire(self, now):
+        """Remove and return the entries whose deadline passed."""
+        expired = []
+        last = self._tick(now)
+        if last <= self.tick:
+            return expired
+        # One revolution visits every slot
+        first = max(self.tick + 1, last - len(self.slots) + 1)
+        self.tick = last
+        for tick in range(first, last + 1):
+            slot = self.slots[tick % len(self.slots)]
+            if not slot:
+                continue
+            for entry in list(slot):
+                if entry.timer_tick > last:
+                    # Due in a later revolution
+                    continue
+                slot.discard(entry)
+                entry.timer_tick = None
+                self.count -= 1
+                if entry.deadline > now:
+                    self.schedule(entry, entry.deadline, now)
+                else:
+                    expired.append(entry)
+        return expired
+
+    def timed_out(self, entry):
+        """Count an expired entry its owner gave up on."""
+        self.expired[entry.deadline_kind] += 1
+
+    def stats(self):
+        return dict(pending=self.count, **{f'{kind}_expired': self.expired[kind]
+                                           for kind in DEADLINES})
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""Load generator and benchmark suite for the server.
+
+python httpbench.py run -p 8080 -o after.json runs the scenarios against
+a running server, every client connection is an asyncio task sending the
+requests of a scenario in a loop. python httpbench.py compare before.json
+after.json flags the scenarios that got slower.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import time
+
+
+# Paths in doc_root with the expected status, any other counts as an error
+SMALL_FILES = (("/httptest/dir2/", 200), ("/httptest/pic_ask.gif", 200),
+               ("/httptest/logo.v2.png", 200), ("/httptest/text..txt", 200),
+               ("/httptest/space%20in%20name.txt", 200))
+LARGE_FILES = (("/httptest/wikipedia_russia.html", 200), ("/httptest/jquery-1.9.1.js", 200),
+               ("/httptest/160313.jpg", 200), ("/httptest/splash.css", 200))
+MISSING_FILES = (("/httptest/missing.html", 404), ("/httptest/dir1/missing/", 404),
+                 ("/nope", 404))
+
+
+class Scenario:
+    """Request mix sent by every client connection."""
+
+    def __init__(self, name, paths, keep_alive=True, pipeline=1):
+        self.name = name
+        # (path, expected status), picked at random
+        self.paths = paths
+        self.keep_alive = keep_alive
+        # Requests written at once before reading their responses
+        self.pipeline = pipeline
+
+    def request(self, path, keep_alive):
+        connection = "keep-alive" if keep_alive else "close"
+        return (f'GET {path} HTTP/1.1\r\nHost: localhost\r\nUser-Agent: httpbench\r\n'
+                f'Connection: {connection}\r\n\r\n').encode("ascii")
+
+
+def scenarios(pipeline_depth):
+    return {
+        'small': Scenario('small', SMALL_FILES),
+        'large': Scenario('large', LARGE_FILES),
+        'not_found': Scenario('not_found', MISSING_FILES),
+        'mixed': Scenario('mixed', SMALL_FILES * 6 + LARGE_FILES + MISSING_FILES),
+        'small_close': Scenario('small_close', SMALL_FILES, keep_alive=False),
+        'small_pipelined': Scenario('small_pipelined', SMALL_FILES, pipeline=pipeline_depth),
+    }
+
+
+class Stats:
+    __slots__ = ("requests", "errors", "bytes", "latencies")
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+        self.latencies = []
+
+
+async def read_response(reader):
+    """Status, body length and whether the server keeps the connection."""
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.split(b"\r\n")
+    status = int(lines[0].split(b" ", 2)[1])
+    length = 0
+    keep_alive = True
+    for line in lines[1:]:
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        if name == b"content-length":
+            length = int(value)
+        elif name == b"connection":
+            keep_alive = value.strip().lower() != b"close"
+    if length:
+        await reader.readexactly(length)
+    return status, len(head) + length, keep_alive
+
+
+async def run_client(host, port, scenario, deadline, stats, record_after):
+    """One connection at a time, reconnects when the server closes it."""
+    choice = random.Random(os.getpid() ^ id(stats)).choice
+    writer = None
+    while time.monotonic() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            batch = [choice(scenario.paths) for _ in range(scenario.pipeline)]
+            writer.write(b"".join(scenario.request(path, scenario.keep_alive)
+                                  for path, _ in batch))
+            started = time.monotonic()
+            server_keeps = True
+            for _, expected in batch:
+                status, size, server_keeps = await read_response(reader)
+                finished = time.monotonic()
+                if started >= record_after:
+                    stats.requests += 1
+                    stats.bytes += size
+                    stats.latencies.append(finished - started)
+                    if status != expected:
+                        stats.errors += 1
+                if not server_keeps:
+                    # The rest of the batch is dropped, keepalive_requests was reached
+                    break
+            if not scenario.keep_alive or not server_keeps:
+                writer.close()
+                writer = None
+        except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+            if time.monotonic() >= record_after:
+                stats.errors += 1
+            if writer is not None:
+                writer.close()
+                writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def run_clients(host, port, scenario, concurrency, warmup, duration):
+    stats = Stats()
+    record_after = time.monotonic() + warmup
+    deadline = record_after + duration
+    await asyncio.gather(*[run_client(host, port, scenario, deadline, stats, record_after)
+                           for _ in range(concurrency)])
+    return stats
+
+
+def run_process(args):
+    host, port, scenario, concurrency, warmup, duration = args
+    stats = asyncio.run(run_clients(host, port, scenario, concurrency, warmup, duration))
+    return stats.requests, stats.errors, stats.bytes, stats.latencies
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def run_scenario(host, port, scenario, concurrency, processes, warmup, duration):
+    """Spread the connections over client processes, a single asyncio
+    client saturates one core before a multi-worker server does."""
+    processes = max(1, min(processes, concurrency))
+    shares = [concurrency // processes + (i < concurrency % processes)
+              for i in range(processes)]
+    jobs = [(host, port, scenario, share, warmup, duration) for share in shares]
+    if processes == 1:
+        results = [run_process(jobs[0])]
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(run_process, jobs)
+    requests = sum(result[0] for result in results)
+    latencies = sorted(latency for result in results for latency in result[3])
+    return {
+        'requests': requests,
+        'errors': sum(result[1] for result in results),
+        'rps': round(requests / duration, 1),
+        'mb_per_s': round(sum(result[2] for result in results) / duration / 1e6, 2),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p90_ms': round(percentile(latencies, 0.9) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000 if latencies else 0.0, 3),
+        'concurrency': concurrency,
+        'keep_alive': scenario.keep_alive,
+        'pipeline': scenario.pipeline,
+    }
+
+
+def print_result(name, result):
+    print(f'{name:<16} {result["rps"]:>10.1f} req/s {result["mb_per_s"]:>9.2f} MB/s  '
+          f'p50 {result["p50_ms"]:.3f}  p90 {result["p90_ms"]:.3f}  '
+          f'p99 {result["p99_ms"]:.3f} ms  errors {result["errors"]}')
+
+
+def run(args):
+    available = scenarios(args.pipeline_depth)
+    names = args.scenarios.split(",") if args.scenarios else list(available)
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        sys.exit(f'unknown scenarios: {", ".join(unknown)}, known: {", ".join(available)}')
+    report = {
+        'meta': {
+            'started': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            'target': f'{args.host}:{args.port}',
+            'label': args.label,
+            'duration': args.duration,
+            'warmup': args.warmup,
+            'processes': args.processes,
+            'python': platform.python_version(),
+            'machine': platform.node(),
+            'cpus': os.cpu_count(),
+        },
+        'results': {},
+    }
+    for name in names:
+        result = run_scenario(args.host, args.port, available[name], args.concurrency,
+                              args.processes, args.warmup, args.duration)
+        report['results'][name] = result
+        print_result(name, result)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+            output.write("\n")
+    return 0
+
+
+def compare(args):
+    """Exit status 1 if a scenario lost more than threshold of its
+    throughput or its p99 latency grew by more than threshold."""
+    with open(args.before) as before_file, open(args.after) as after_file:
+        before = json.load(before_file)['results']
+        after = json.load(after_file)['results']
+    regressions = 0
+    print(f'{"scenario":<16} {"req/s before":>13} {"after":>10} {"change":>8}  '
+          f'{"p99 before":>11} {"after":>9} {"change":>8}')
+    for name in before:
+        if name not in after:
+            continue
+        old, new = before[name], after[name]
+        rps_change = (new['rps'] - old['rps']) / old['rps'] if old['rps'] else 0.0
+        p99_change = (new['p99_ms'] - old['p99_ms']) / old['p99_ms'] if old['p99_ms'] else 0.0
+        flags = []
+        if rps_change < -args.threshold:
+            flags.append('throughput')
+        if p99_change > args.threshold:
+            flags.append('p99')
+        if new['errors'] > old['errors']:
+            flags.append('errors')
+        if flags:
+            regressions += 1
+        print(f'{name:<16} {old["rps"]:>13.1f} {new["rps"]:>10.1f} {rps_change:>+8.1%}  '
+              f'{old["p99_ms"]:>11.3f} {new["p99_ms"]:>9.3f} {p99_change:>+8.1%}'
+              f'{"  REGRESSION: " + ", ".join(flags) if flags else ""}')
+    return 1 if regressions else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='OTUServer load generator')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the scenarios against a server')
+    run_parser.add_argument(
+        '-hs', '--host', type=str, default="localhost",
+        help='server host, default - localhost'
+    )
+    run_parser.add_argument(
+        '-p', '--port', type=int, default=80,
+        help='server port, default - 80'
+    )
+    run_parser.add_argument(
+        '-s', '--scenarios', type=str, default=None,
+        help='comma separated scenarios: small, large, not_found, mixed, small_close, '
+             'small_pipelined, default - all'
+    )
+    run_parser.add_argument(
+        '-c', '--concurrency', type=int, default=16,
+        help='client connections, default - 16'
+    )
+    run_parser.add_argument(
+        '--processes', type=int, default=1,
+        help='client processes sharing the connections, default - 1'
+    )
+    run_parser.add_argument(
+        '-d', '--duration', type=float, default=5.0,
+        help='measured seconds per scenario, default - 5'
+    )
+    run_parser.add_argument(
+        '--warmup', type=float, default=1.0,
+        help='seconds of load per scenario before measuring, default - 1'
+    )
+    run_parser.add_argument(
+        '--pipeline-depth', type=int, default=8,
+        help='requests in flight per connection of small_pipelined, default - 8'
+    )
+    run_parser.add_argument(
+        '-o', '--output', type=str, default=None,
+        help='write the results to this JSON file'
+    )
+    run_parser.add_argument(
+        '--label', type=str, default=None,
+        help='free text stored with the results, e.g. a commit'
+    )
+    run_parser.set_defaults(handler=run)
+
+    compare_parser = commands.add_parser('compare', help='flag regressions between two runs')
+    compare_parser.add_argument('before', help='JSON results of the baseline run')
+    compare_parser.add_argument('after', help='JSON results of the new run')
+    compare_parser.add_argument(
+        '-t', '--threshold', type=float, default=0.1,
+        help='relative throughput loss or p99 growth reported, default - 0.1'
+    )
+    compare_parser.set_defaults(handler=compare)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.exit(args.handler(args))
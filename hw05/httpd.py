@@ -3,59 +3,395 @@
 import sys
 import socket
 import selectors
-import traceback
 import lib_for_http_server as lib_helper
+import asyncio_engine
+import http_cache
+import http_gzip
+import http_timers
 import os
 import argparse
+import errno
+import signal
+import time
+import multiprocessing
+import logging
+import http_log
+from http_log import log, access_log
+from http_metrics import metrics
 
 
 class MultiprocessSocketServer:
 
-    def __init__(self, host="", port=80, workers=1, rootdir=os.path.abspath("./doc_root")):
+    # A worker that dies sooner than this after start is considered crashing,
+    # restart is delayed to avoid a fork loop.
+    min_worker_uptime = 1.0
+
+    def __init__(self, host="", port=80, workers=1, rootdir=os.path.abspath("./doc_root"),
+                 reuseport=False, stats_interval=10.0, backlog=511, accept_batch=32,
+                 max_connections=512, max_total_connections=0, connections_low_watermark=0.9,
+                 keepalive_requests=100, keepalive_timeout=5.0,
+                 header_timeout=10.0, send_timeout=30.0,
+                 use_sendfile=True, chunk_size=65536,
+                 low_watermark=65536, high_watermark=131072,
+                 cache_size=0, cache_max_file_size=1024 * 1024, cache_revalidate=1.0,
+                 path_cache_size=10000, path_cache_ttl=1.0,
+                 max_header_size=8192, max_pipeline=16, engine="selector",
+                 io_threads=4, stall_threshold=0.05,
+                 gzip=True, gzip_precompress=False, gzip_cache_size=8 * 1024 * 1024,
+                 access_log_path=None, metrics_path="/__metrics"):
         self.host = host
         self.port = port
-        self.sel = selectors.DefaultSelector()
+        self.sel = None
         self.workers = workers
         self.rootdir = rootdir
+        # Every worker binds its own SO_REUSEPORT socket instead of sharing one
+        self.reuseport = reuseport and workers > 1
+        self.stats_interval = stats_interval
+        self.backlog = backlog
+        # Connections accepted per wakeup of the listening socket
+        self.accept_batch = accept_batch
+        self.connection_limit = lib_helper.ConnectionLimit(
+            workers, max_connections, max_total_connections, connections_low_watermark)
+        # "selector" - hand-written selectors loop, "asyncio" - asyncio_engine
+        self.engine = engine
+        # Threads for blocking file-system calls, 0 - they run on the event loop
+        self.io_threads = io_threads
+        self.io_pool = None
+        self.stall_monitor = lib_helper.LoopStallMonitor(stall_threshold)
+        # keepalive_requests=1 turns persistent connections off
+        self.keepalive_requests = keepalive_requests
+        self.keepalive_timeout = keepalive_timeout
+        # Seconds to receive a request head, between two sends of a response
+        # and between requests, tracked per worker in a TimerWheel
+        self.timeouts = {http_timers.HEADER: header_timeout,
+                         http_timers.SEND: send_timeout,
+                         http_timers.KEEPALIVE: keepalive_timeout}
+        self.timers = None
+        self.max_header_size = max_header_size
+        self.max_pipeline = max_pipeline
+        self.processor_options = dict(use_sendfile=use_sendfile,
+                                      chunk_size=chunk_size,
+                                      low_watermark=low_watermark,
+                                      high_watermark=high_watermark)
+        self.error_responses = lib_helper.ErrorResponseTable()
+        self.processor_options['error_responses'] = self.error_responses
+        if cache_size > 0:
+            # Every worker fills its own copy after fork
+            self.processor_options['file_cache'] = http_cache.LRUFileCache(
+                max_bytes=cache_size, max_file_size=cache_max_file_size,
+                revalidate_after=cache_revalidate)
+        if path_cache_size > 0:
+            # Request targets resolved to files, 403s and 404s, per worker
+            self.processor_options['path_cache'] = http_cache.PathCache(
+                max_entries=path_cache_size, ttl=path_cache_ttl)
+        # Write missing file.gz variants before the workers start
+        self.gzip_precompress = gzip and gzip_precompress
+        self.processor_options['gzip_static'] = gzip
+        if metrics_path:
+            # Shared memory, every worker counts into its own slot
+            metrics.setup(max(workers, 1), lib_helper.RESPONSE_CODES)
+            self.processor_options['metrics_path'] = metrics_path
+        if gzip and gzip_cache_size > 0:
+            # Like the file cache, every worker compresses into its own copy
+            self.processor_options['gzip_cache'] = http_gzip.GzipCache(
+                max_bytes=gzip_cache_size, max_file_size=cache_max_file_size)
+        # One stateless processor serves all connections of a worker
+        self.request_processor = lib_helper.HTTPRequestProcessor(self.rootdir,
+                                                                 **self.processor_options)
+        # Every worker writes its own file, None - the server log stream
+        self.access_log_path = access_log_path
+        self.lsock = None
+        self.worker_id = None
+        # pid -> (worker_id, start time), filled only in the master process
+        self.children = {}
+        # Shared memory: accepted connections per worker, survives restarts
+        self.accept_counts = multiprocessing.RawArray('Q', max(workers, 1))
+        self._reported_counts = None
 
     def serve_forever(self):
+        if self.gzip_precompress:
+            log.info('%d gzip variants written', http_gzip.precompress(self.rootdir))
+        if not self.reuseport:
+            self.lsock = self._create_listen_socket()
+        log.info('listening on %s%s', (self.host, self.port),
+                 ' with SO_REUSEPORT' if self.reuseport else '')
+        if self.workers <= 1:
+            self._run_worker(0)
+            return
+        signal.signal(signal.SIGTERM, self._handle_sigterm)
+        signal.signal(signal.SIGHUP, self._forward_sighup)
+        signal.signal(signal.SIGUSR1, self._forward_signal)
+        try:
+            for worker_id in range(self.workers):
+                self._spawn_worker(worker_id)
+            self._watch_workers()
+        except KeyboardInterrupt:
+            log.info('caught keyboard interrupt, stopping workers')
+        finally:
+            self._stop_workers()
+            self.report_accept_counts()
+            if self.lsock is not None:
+                self.lsock.close()
+
+    def _create_listen_socket(self, reuseport=False):
         lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # Avoid bind() exception: OSError: [Errno 48] Address already in use
         lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuseport:
+            # The kernel balances incoming connections between all sockets
+            # bound to the same address, only one worker is woken per connection
+            lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         lsock.bind((self.host, self.port))
-        lsock.listen()
-        print('listening on', (self.host, self.port))
+        lsock.listen(self.backlog)
         lsock.setblocking(False)
-        self.sel.register(lsock, selectors.EVENT_READ, data=None)
+        return lsock
+
+    def _spawn_worker(self, worker_id):
+        pid = os.fork()
+        if pid == 0:
+            # Child: never return into the master code path
+            exit_code = 0
+            try:
+                # Leave the event loop through terminate() to report the stats
+                signal.signal(signal.SIGTERM, self._handle_sigterm)
+                self.children = {}
+                self._run_worker(worker_id)
+            except BaseException:
+                log.exception('worker %d failed', worker_id)
+                exit_code = 1
+            finally:
+                # Write out the buffered log records, os._exit skips atexit
+                logging.shutdown()
+                os._exit(exit_code)
+        log.info('started worker %d with pid %d', worker_id, pid)
+        self.children[pid] = (worker_id, time.monotonic())
+
+    def _watch_workers(self):
+        next_report = time.monotonic() + self.stats_interval
+        while self.children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                time.sleep(0.2)
+                if time.monotonic() >= next_report:
+                    self.report_accept_counts()
+                    next_report = time.monotonic() + self.stats_interval
+                continue
+            if pid not in self.children:
+                continue
+            worker_id, started = self.children.pop(pid)
+            log.warning('worker %d (pid %d) exited with status %d, restarting',
+                        worker_id, pid, status)
+            if time.monotonic() - started < self.min_worker_uptime:
+                time.sleep(self.min_worker_uptime)
+            self._spawn_worker(worker_id)
+
+    def _stop_workers(self):
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(self.children):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+            del self.children[pid]
+
+    def report_accept_counts(self):
+        counts = list(self.accept_counts)
+        total = sum(counts)
+        if not total or counts == self._reported_counts:
+            return
+        self._reported_counts = counts
+        shares = ", ".join(f'{worker_id}: {count} ({count * 100 / total:.1f}%)'
+                           for worker_id, count in enumerate(counts))
+        log.info('accepted connections per worker - %s', shares)
+
+    @staticmethod
+    def _handle_sigterm(signum, frame):
+        raise KeyboardInterrupt
+
+    def _forward_sighup(self, signum, frame):
+        self.error_responses.reload()
+        self._forward_signal(signum, frame)
+
+    def _forward_signal(self, signum, frame):
+        for pid in self.children:
+            os.kill(pid, signum)
+
+    @staticmethod
+    def _reopen_access_log(signum, frame):
+        access_log.reopen()
+
+    def access_log_file(self, worker_id):
+        """access.log -> access.0.log, ... when there are several workers."""
+        if self.workers <= 1:
+            return self.access_log_path
+        root, ext = os.path.splitext(self.access_log_path)
+        return f'{root}.{worker_id}{ext}'
+
+    def _reload_error_templates(self, signum, frame):
+        log.info('worker %d: reloading error templates', self.worker_id)
+        self.error_responses.reload()
+
+    def _run_worker(self, worker_id):
+        self.worker_id = worker_id
+        self.timers = http_timers.TimerWheel(max_delay=min(self.timeouts.values()))
+        self.connection_limit.attach(worker_id)
+        metrics.attach(worker_id)
+        signal.signal(signal.SIGHUP, self._reload_error_templates)
+        if self.access_log_path is not None:
+            access_log.open(self.access_log_file(worker_id))
+            # Sent by logrotate after moving the files
+            signal.signal(signal.SIGUSR1, self._reopen_access_log)
+        if self.reuseport:
+            self.lsock = self._create_listen_socket(reuseport=True)
         try:
-            while True:
-                events = self.sel.select(timeout=None)
-                for key, mask in events:
-                    if key.data is None:
-                        self.accept_wrapper(key.fileobj)
-                    else:
-                        message = key.data
-                        try:
-                            message.process_events(mask)
-                        except Exception:
-                            print('main: error: exception for',
-                                  f'{message.addr}:\n{traceback.format_exc()}')
-                            message.close()
+            if self.engine == "asyncio":
+                asyncio_engine.serve(self)
+            else:
+                if self.io_threads > 0:
+                    self.io_pool = lib_helper.BlockingIOPool(self.io_threads)
+                self._selector_loop()
         except KeyboardInterrupt:
-            print('caught keyboard interrupt, exiting')
+            log.info('caught keyboard interrupt, exiting')
         finally:
             self.terminate()
 
-    def accept_wrapper(self, sock):
+    def _selector_loop(self):
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(self.lsock, selectors.EVENT_READ, data=None)
+        if self.io_pool is not None:
+            self.sel.register(self.io_pool, selectors.EVENT_READ, data=self.io_pool)
+        self.connection_limit.on_pause = self._pause_accepting
+        while True:
+            # Collected access records and metrics of an idle worker wait
+            # at most a second too
+            timeout = self.keepalive_timeout
+            if self.timers or self.connection_limit.paused:
+                timeout = min(timeout, self.timers.resolution)
+            if access_log.records:
+                timeout = min(timeout, access_log.flush_interval)
+            if metrics.values is not None:
+                timeout = min(timeout, metrics.publish_interval)
+            events = self.sel.select(timeout=timeout)
+            started = time.monotonic()
+            self.request_processor.date.refresh()
+            for key, mask in events:
+                if key.data is None:
+                    try:
+                        self.accept_wrapper(key.fileobj)
+                    except Exception:
+                        log.exception('worker %d: can not accept', self.worker_id)
+                elif key.data is self.io_pool:
+                    self.io_pool.process_events(mask)
+                else:
+                    message = key.data
+                    try:
+                        message.process_events(mask)
+                    except Exception:
+                        log.exception('exception for %s', message.addr)
+                        message.close()
+            now = time.monotonic()
+            for connection in self.timers.expire(now):
+                connection.expire(now)
+            if self.connection_limit.paused:
+                self.connection_limit.check(now)
+            access_log.flush_if_due(now)
+            metrics.publish_if_due(now)
+            busy = time.monotonic() - started
+            self.stall_monitor.record(busy)
+            metrics.observe_loop(busy)
+
+    def new_connection(self, submit=None, addr=None):
+        """Engine independent protocol state for an accepted connection."""
+        return lib_helper.HTTPConnection(self.request_processor,
+                                         keepalive_requests=self.keepalive_requests,
+                                         max_header_size=self.max_header_size,
+                                         max_pipeline=self.max_pipeline,
+                                         submit=submit,
+                                         remote_addr=addr,
+                                         timers=self.timers,
+                                         timeouts=self.timeouts,
+                                         connection_limit=self.connection_limit)
 
-        conn, addr = sock.accept()  # Should be ready to read
-        print('accepted connection from', addr)
-        conn.setblocking(False)
-        message = lib_helper.Message(self.sel, conn, addr, self.rootdir)
-        self.sel.register(conn, selectors.EVENT_READ, data=message)
+    def accept_connections(self, sock):
+        """Up to accept_batch pending (socket, address) pairs, a burst is
+        drained in a few wakeups. Stops early once the connection limit
+        pauses accepting, a connection that fails before it is accepted is
+        skipped."""
+        accepted = []
+        limit = self.connection_limit
+        for _ in range(self.accept_batch):
+            if limit.paused:
+                break
+            try:
+                conn, addr = sock.accept()
+            except BlockingIOError:
+                # Drained, or another worker took the connection first
+                break
+            except OSError as e:
+                if e.errno in (errno.ECONNABORTED, errno.EPROTO, errno.EPERM):
+                    # Reset by the client while queued, or refused by a firewall
+                    log.debug('worker %d: connection lost before accept: %s',
+                              self.worker_id, e)
+                    continue
+                if e.errno not in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    if accepted:
+                        # Hand over the connections accepted so far
+                        log.error('worker %d: can not accept: %s', self.worker_id, e)
+                        break
+                    raise
+                log.error('worker %d: can not accept: %s, retrying in a second',
+                          self.worker_id, e)
+                limit.accept_failed(time.monotonic())
+                break
+            self.accept_counts[self.worker_id] += 1
+            limit.opened()
+            # Responses leave in whole writes, Nagle would only hold back the
+            # last packet of one until the previous is acknowledged. asyncio
+            # sets it only on sockets created with proto IPPROTO_TCP
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            accepted.append((conn, addr))
+        return accepted
+
+    def _pause_accepting(self, paused):
+        if paused:
+            self.sel.unregister(self.lsock)
+        else:
+            self.sel.register(self.lsock, selectors.EVENT_READ, data=None)
+
+    def accept_wrapper(self, sock):
+        submit = self.io_pool.submit if self.io_pool is not None else None
+        for conn, addr in self.accept_connections(sock):
+            log.debug('accepted connection from %s', addr)
+            conn.setblocking(False)
+            message = lib_helper.Message(self.sel, conn, addr, self.new_connection(submit, addr))
+            self.sel.register(conn, selectors.EVENT_READ, data=message)
 
     def terminate(self):
-        self.sel.close()
+        file_cache = self.processor_options.get('file_cache')
+        if file_cache is not None:
+            log.info('worker %d file cache: %s', self.worker_id, file_cache.stats())
+        path_cache = self.processor_options.get('path_cache')
+        if path_cache is not None:
+            log.info('worker %d path cache: %s', self.worker_id, path_cache.stats())
+        gzip_cache = self.processor_options.get('gzip_cache')
+        if gzip_cache is not None:
+            log.info('worker %d gzip cache: %s', self.worker_id, gzip_cache.stats())
+        log.info('worker %d event loop: %s', self.worker_id, self.stall_monitor.stats())
+        if self.timers is not None:
+            log.info('worker %d deadlines: %s', self.worker_id, self.timers.stats())
+        log.info('worker %d connections: %s', self.worker_id, self.connection_limit.stats())
+        access_log.close()
+        if self.io_pool is not None:
+            self.io_pool.close()
+        if self.sel is not None:
+            self.sel.close()
+        if self.reuseport:
+            self.lsock.close()
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description='OTUServer')
@@ -75,16 +411,198 @@ def parse_args():
         '-r', '--root', type=str, default='doc_root',
         help='DIRECTORY_ROOT with site files, default - doc_root'
     )
+    parser.add_argument(
+        '--reuseport', action='store_true',
+        help='bind a separate SO_REUSEPORT listening socket in every worker'
+    )
+    parser.add_argument(
+        '--backlog', type=int, default=511,
+        help='listen queue length, capped by net.core.somaxconn, default - 511'
+    )
+    parser.add_argument(
+        '--accept-batch', type=int, default=32,
+        help='connections accepted per wakeup of the listening socket, default - 32'
+    )
+    parser.add_argument(
+        '--max-connections', type=int, default=512,
+        help='open connections per worker before accepting pauses, 0 - no limit, '
+             'default - 512'
+    )
+    parser.add_argument(
+        '--max-total-connections', type=int, default=0,
+        help='open connections of all workers before accepting pauses, 0 - no limit, '
+             'default - 0'
+    )
+    parser.add_argument(
+        '--connections-low-watermark', type=float, default=0.9,
+        help='accepting resumes below this fraction of the connection limits, default - 0.9'
+    )
+    parser.add_argument(
+        '--stats-interval', type=float, default=10.0,
+        help='seconds between per-worker accept count reports, default - 10'
+    )
+    parser.add_argument(
+        '--keepalive-requests', type=int, default=100,
+        help='max requests served over one connection, 1 disables keep-alive, default - 100'
+    )
+    parser.add_argument(
+        '--keepalive-timeout', type=float, default=5.0,
+        help='seconds an idle persistent connection is kept open, default - 5'
+    )
+    parser.add_argument(
+        '--header-timeout', type=float, default=10.0,
+        help='seconds to receive a whole request head, default - 10'
+    )
+    parser.add_argument(
+        '--send-timeout', type=float, default=30.0,
+        help='seconds a response may wait for the client to read, default - 30'
+    )
+    parser.add_argument(
+        '--no-sendfile', action='store_true',
+        help='stream files through a bounded buffer instead of os.sendfile'
+    )
+    parser.add_argument(
+        '--chunk-size', type=int, default=65536,
+        help='bytes read from a streamed file at once, default - 65536'
+    )
+    parser.add_argument(
+        '--low-watermark', type=int, default=65536,
+        help='streamed body is refilled when less is buffered, default - 65536'
+    )
+    parser.add_argument(
+        '--high-watermark', type=int, default=131072,
+        help='max bytes buffered per streamed body, default - 131072'
+    )
+
+    parser.add_argument(
+        '--cache-size', type=int, default=0,
+        help='bytes of small static files kept in memory per worker, default - 0 (off)'
+    )
+    parser.add_argument(
+        '--cache-max-file', type=int, default=1024 * 1024,
+        help='largest file put into the cache, default - 1048576'
+    )
+    parser.add_argument(
+        '--cache-revalidate', type=float, default=1.0,
+        help='seconds a cached file is served without checking mtime and size, default - 1'
+    )
+    parser.add_argument(
+        '--path-cache-size', type=int, default=10000,
+        help='request targets with their file metadata or 403/404 kept per worker, '
+             'default - 10000, 0 - off'
+    )
+    parser.add_argument(
+        '--path-cache-ttl', type=float, default=1.0,
+        help='seconds a resolved target is trusted without a system call, default - 1'
+    )
+
+    parser.add_argument(
+        '--max-header-size', type=int, default=8192,
+        help='max bytes of a request line and headers, default - 8192'
+    )
+
+    parser.add_argument(
+        '--max-pipeline', type=int, default=16,
+        help='queued responses per connection before reading pauses, default - 16'
+    )
+
+    parser.add_argument(
+        '--engine', choices=['selector', 'asyncio'], default='selector',
+        help='event loop implementation, default - selector'
+    )
+
+    parser.add_argument(
+        '--io-threads', type=int, default=4,
+        help='threads per worker for blocking file-system calls, 0 - run them '
+             'on the event loop, default - 4'
+    )
+    parser.add_argument(
+        '--stall-threshold', type=float, default=50,
+        help='milliseconds of a busy event loop reported as a stall, default - 50'
+    )
+
+    parser.add_argument(
+        '--no-gzip', action='store_true',
+        help='never send gzip encoded responses'
+    )
+    parser.add_argument(
+        '--gzip-precompress', action='store_true',
+        help='write file.gz variants of compressible files under the root at start'
+    )
+    parser.add_argument(
+        '--gzip-cache-size', type=int, default=8 * 1024 * 1024,
+        help='bytes of files compressed on the fly kept per worker, 0 - serve only '
+             'file.gz variants, default - 8388608'
+    )
+
+    parser.add_argument(
+        '--log-level', choices=http_log.LEVELS, default='info',
+        help='server messages of lower levels are dropped, default - info'
+    )
+    parser.add_argument(
+        '--no-access-log', action='store_true',
+        help='do not log every request'
+    )
+    parser.add_argument(
+        '--access-log', type=str, default=None,
+        help='access log file, every worker writes its own, e.g. access.0.log, reopened '
+             'on SIGUSR1, default - the server log stream'
+    )
+    parser.add_argument(
+        '--access-log-format', choices=http_log.AccessLog.formats, default='combined',
+        help='access log line format, both end with the response time, default - combined'
+    )
+
+    parser.add_argument(
+        '--metrics-path', type=str, default='/__metrics',
+        help='path of the Prometheus metrics of all workers, empty - no metrics, '
+             'default - /__metrics'
+    )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.low_watermark > args.high_watermark:
+        parser.error('--low-watermark must not exceed --high-watermark')
+    return args
 
 
 if __name__ == "__main__":
     args = parse_args()
+    http_log.setup_logging(args.log_level, access=not args.no_access_log,
+                           access_format=args.access_log_format)
     init_args = dict(host=args.host,
                      port=args.port,
                      workers=args.workers,
-                     rootdir=args.root)
+                     rootdir=args.root,
+                     reuseport=args.reuseport,
+                     stats_interval=args.stats_interval,
+                     backlog=args.backlog,
+                     accept_batch=args.accept_batch,
+                     max_connections=args.max_connections,
+                     max_total_connections=args.max_total_connections,
+                     connections_low_watermark=args.connections_low_watermark,
+                     keepalive_requests=args.keepalive_requests,
+                     keepalive_timeout=args.keepalive_timeout,
+                     header_timeout=args.header_timeout,
+                     send_timeout=args.send_timeout,
+                     use_sendfile=not args.no_sendfile,
+                     chunk_size=args.chunk_size,
+                     low_watermark=args.low_watermark,
+                     high_watermark=args.high_watermark,
+                     cache_size=args.cache_size,
+                     cache_max_file_size=args.cache_max_file,
+                     cache_revalidate=args.cache_revalidate,
+                     path_cache_size=args.path_cache_size,
+                     path_cache_ttl=args.path_cache_ttl,
+                     max_header_size=args.max_header_size,
+                     max_pipeline=args.max_pipeline,
+                     engine=args.engine,
+                     io_threads=args.io_threads,
+                     stall_threshold=args.stall_threshold / 1000,
+                     gzip=not args.no_gzip,
+                     gzip_precompress=args.gzip_precompress,
+                     gzip_cache_size=args.gzip_cache_size,
+                     access_log_path=None if args.no_access_log else args.access_log,
+                     metrics_path=args.metrics_path)
     server = MultiprocessSocketServer(**init_args)
     server.serve_forever()
 
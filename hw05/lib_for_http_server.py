@@ -1,27 +1,535 @@
 import os
 import selectors
-import datetime
+import email.utils
 import mimetypes
 import re
+import time
+import collections
+import socket
+import concurrent.futures
+import multiprocessing
+from stat import S_ISDIR, S_ISREG
+
+import http_parser
+import http_cache
+import http_gzip
+import http_metrics
+import http_timers
+from http_log import log, access_log
+from http_metrics import metrics
+
+
+RESPONSE_CODES = {"200": "OK",
+                  "206": "Partial Content",
+                  "304": "Not Modified",
+                  "400": "Bad Request",
+                  "431": "Request Header Fields Too Large",
+                  "500": "Internal sever Error",
+                  "405": "Method Unsupported",
+                  "403": "Access Denied",
+                  "404": "Resource Not Fund",
+                  "416": "Range Not Satisfiable",
+                  }
+
+
+_HEXDIG = '0123456789ABCDEFabcdef'
+_HEXTOBYTE = {
+    ("%" + a + b).encode(): bytes([int(a + b, 16)])
+    for a in _HEXDIG for b in _HEXDIG
+}
+
+
+CONNECTION_HEADERS = {True: b"Connection: keep-alive\r\n",
+                      False: b"Connection: close\r\n"}
+
+
+def file_validators(mtime_ns, size, encoding=None):
+    """ETag and Last-Modified of a file, derived from its stat alone.
+    Every content coding of the file gets its own ETag."""
+    etag = f'"{mtime_ns:x}-{size:x}-{encoding}"' if encoding else f'"{mtime_ns:x}-{size:x}"'
+    return etag, email.utils.formatdate(mtime_ns // 1000000000, usegmt=True)
+
+
+def byte_range(value, size):
+    """(first, last) byte positions of a single range Range header.
+
+    None when the header is ignored and the whole file is sent: another
+    unit, a malformed value or several ranges. first > last when the range
+    can't be satisfied.
+    """
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep or last and not last.isdigit():
+        return None
+    if not first:
+        if not last:
+            return None
+        # Suffix range: the last bytes of the file
+        length = int(last)
+        return max(size - length, 0) if length else size, size - 1
+    if not first.isdigit():
+        return None
+    first = int(first)
+    if not last:
+        return first, size - 1
+    last = int(last)
+    if last < first:
+        return None
+    return first, min(last, size - 1)
+
+
+def _parse_http_date(value):
+    """Seconds since the epoch, -1 for a date that can't be parsed."""
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return -1
+    return email.utils.mktime_tz(parsed)
+
+
+class HTTPDate:
+    """RFC 7231 Date header, formatted at most once per second.
+
+    The event loop calls refresh() when it wakes up, responses only read
+    header, also from I/O threads.
+    """
+    __slots__ = ("second", "header")
+
+    def __init__(self):
+        self.second = None
+        self.header = None
+        self.refresh()
+
+    def refresh(self, now=None):
+        second = int(time.time() if now is None else now)
+        if second != self.second:
+            date = email.utils.formatdate(second, usegmt=True)
+            self.header = f'Date: {date}\r\n'.encode("ascii")
+            self.second = second
+
+
+# Buffers gathered by one sendmsg() call, well below IOV_MAX
+SEND_SEGMENTS = 64
+# Linux only: hold a head back until the file body sent next fills the packet
+MSG_MORE = getattr(socket, "MSG_MORE", 0)
+
+
+class QueuedResponse:
+    """Response waiting in the pipeline of a connection. It is pending,
+    with segments None, while its file is loaded in an I/O thread."""
+    __slots__ = ("segments", "body", "keep_alive", "request", "started", "responsecode",
+                 "head_length", "body_length", "fs_calls")
+
+    def __init__(self, segments, body, keep_alive, request=None, started=None):
+        # Head and in-memory body still to send, a partial send replaces the
+        # first one with a memoryview of its rest
+        self.segments = segments
+        # Response body that is not kept in memory: FileBody or StreamBody
+        self.body = body
+        self.keep_alive = keep_alive
+        # For the access log and metrics: the request, monotonic time it
+        # was parsed, status and bytes of the response
+        self.request = request
+        self.started = started
+        self.responsecode = None
+        self.head_length = 0
+        self.body_length = 0
+        # File-system calls made by load_file
+        self.fs_calls = 0
+
+    @property
+    def ready(self):
+        return self.segments is not None
+
+    @property
+    def done(self):
+        return (self.segments is not None and not self.segments
+                and (self.body is None or self.body.done))
+
+    def close(self):
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+
+
+class HTTPConnection:
+    """Protocol state of one client connection, independent of the engine.
+
+    Parses the received bytes, decides whether the connection is kept
+    alive and queues the responses of pipelined requests in request order.
+    It does no I/O: the selector Message and the asyncio HTTPProtocol feed
+    it data and write out its responses.
+    """
+
+    def __init__(self, request_processor, keepalive_requests=100,
+                 max_header_size=8192, max_pipeline=16, submit=None, remote_addr=None,
+                 timers=None, timeouts=None, connection_limit=None):
+        self.request_processor = request_processor
+        self.remote_addr = remote_addr
+        # submit(fn, args, callback) runs fn in an I/O thread and calls
+        # callback(future) on the loop thread, None - file I/O on the loop
+        self.submit = submit
+        # Set by the engine, called when a pending response becomes ready
+        self.on_response_ready = None
+        # Set by the engine, closes the connection after a missed deadline
+        # or keeps it with rearm()
+        self.on_timeout = None
+        self.closed = False
+        self.parser = http_parser.RequestParser(max_header_size=max_header_size)
+        # Responses of pipelined requests, sent strictly in request order
+        self.responses = collections.deque()
+        self.max_pipeline = max_pipeline
+        # No more requests are read once a response will close the connection
+        self.closing = False
+        # Half-closed by the peer: answer what was already requested
+        self.peer_closed = False
+        self.keepalive_requests = keepalive_requests
+        self.requests_received = 0
+        self.requests_served = 0
+        # http_timers.TimerWheel of the worker and seconds of each deadline kind
+        self.timers = timers
+        self.timeouts = timeouts
+        # ConnectionLimit that counted the accepted socket
+        self.connection_limit = connection_limit
+        self.deadline = None
+        self.deadline_kind = None
+        self.timer_tick = None
+        metrics.connection_opened()
+        if timers is not None:
+            now = time.monotonic()
+            self.deadline_kind = http_timers.HEADER
+            timers.schedule(self, now + timeouts[http_timers.HEADER], now)
+
+    @property
+    def reading_allowed(self):
+        # Back-pressure: stop reading while the response queue is full
+        return (not self.closing and not self.peer_closed
+                and len(self.responses) < self.max_pipeline)
+
+    @property
+    def finished(self):
+        """Nothing more will be sent over the connection."""
+        return self.peer_closed and not self.responses
+
+    def feed(self, data):
+        self.parser.feed(data)
+
+    def eof(self):
+        self.peer_closed = True
+
+    def process_requests(self):
+        """Answer every complete request buffered so far, as long as the
+        response queue has room."""
+        while not self.closing and len(self.responses) < self.max_pipeline:
+            try:
+                request = self.parser.next_request()
+            except http_parser.HTTPParseError as error:
+                # The rest of the stream can't be framed, answer and close
+                request = error
+                keep_alive = False
+            else:
+                if request is None:
+                    break
+                keep_alive = (request.keep_alive_requested()
+                              and self.requests_received + 1 < self.keepalive_requests)
+            self.requests_received += 1
+            self.create_response(request, keep_alive)
+        if self.timers is not None:
+            self.update_deadline()
+
+    def update_deadline(self):
+        """Start the deadline of the current phase of the connection.
+
+        The header deadline counts from the first byte of a request, so
+        trickled bytes don't extend it, the send deadline from the last
+        progress, see sent(), the keep-alive deadline from the last response.
+        The wheel checks the connection at least every min(timeouts)
+        seconds, storing the deadline is enough.
+        """
+        if self.responses:
+            kind = http_timers.SEND
+        elif len(self.parser) or not self.requests_received:
+            kind = http_timers.HEADER
+        else:
+            kind = http_timers.KEEPALIVE
+        if kind != self.deadline_kind:
+            self.deadline_kind = kind
+            self.deadline = time.monotonic() + self.timeouts[kind]
+
+    def sent(self, now):
+        """The engine wrote some bytes of a response."""
+        if self.deadline_kind == http_timers.SEND:
+            self.deadline = now + self.timeouts[http_timers.SEND]
+
+    def rearm(self, now):
+        """Put a connection whose send deadline passed back into the wheel,
+        for progress the engine sees but can't report with sent()."""
+        self.sent(now)
+        self.timers.schedule(self, self.deadline, now)
+
+    def expire(self, now):
+        """Called by the engine for a connection returned by TimerWheel.expire()."""
+        kind = self.deadline_kind
+        if self.on_timeout is not None:
+            self.on_timeout()
+        if self.timer_tick is not None:
+            # Kept by on_timeout() with rearm()
+            return
+        log.debug('%s deadline passed for %s', kind, self.remote_addr)
+        self.timers.timed_out(self)
+        metrics.connection_timed_out(kind)
+
+    def create_response(self, request, keep_alive):
+        response = QueuedResponse(None, None, keep_alive, request, time.monotonic())
+        self.responses.append(response)
+        processor = self.request_processor
+        result = processor.start_response(request, keep_alive)
+        if not isinstance(result, FileJob):
+            self._fill_response(response, result)
+            return
+        if self.submit is None:
+            self._fill_response(response, processor.finish_file_response(
+                result, processor.load_file(result)))
+            response.fs_calls = result.fs_calls
+            return
+        if not keep_alive:
+            self.closing = True
+        self.submit(processor.load_file, (result,),
+                    lambda future: self._file_loaded(response, result, future))
+
+    def _fill_response(self, response, processed):
+        # The processor may refuse to keep the connection, e.g. after an error
+        response.keep_alive = processed.keep_alive
+        response.responsecode = processed.responsecode
+        head = processed.head
+        response.head_length = len(head)
+        body = processed.body
+        if isinstance(body, bytes):
+            # Sent together by one sendmsg(), cached files straight from the cache
+            response.segments = [head, body] if body else [head]
+            response.body_length = len(body)
+        else:
+            response.segments = [head]
+            response.body = body
+            response.body_length = (body.remaining if isinstance(body, FileBody)
+                                    else processed.headers['Content-Length'])
+        if not response.keep_alive:
+            self.closing = True
+
+    def _file_loaded(self, response, job, future):
+        if future.cancelled():
+            return
+        try:
+            result = future.result()
+        except Exception:
+            log.exception('file job for %s failed', job.path)
+            result = FileResult("500")
+        if self.closed:
+            result.close()
+            return
+        response.fs_calls = job.fs_calls
+        self._fill_response(response, self.request_processor.finish_file_response(job, result))
+        if self.on_response_ready is not None:
+            self.on_response_ready()
+
+    def finish_response(self):
+        """Drop the fully sent first response, False if the connection
+        must be closed after it."""
+        response = self.responses.popleft()
+        response.close()
+        self.requests_served += 1
+        duration = time.monotonic() - response.started
+        access_log.write(self.remote_addr, response.request, response.responsecode,
+                         response.body_length, duration)
+        metrics.observe_response(response.responsecode,
+                                 response.head_length + response.body_length, duration,
+                                 response.fs_calls)
+        return response.keep_alive
+
+    def close(self):
+        if not self.closed:
+            metrics.connection_closed()
+            if self.timers is not None:
+                self.timers.cancel(self)
+            if self.connection_limit is not None:
+                self.connection_limit.closed()
+        self.closed = True
+        while self.responses:
+            self.responses.popleft().close()
+
+
+class BlockingIOPool:
+    """Bounded thread pool for the blocking file-system calls of the
+    selector engine. A finished job wakes the selector through a socketpair
+    and its callback runs on the loop thread in process_events()."""
+
+    def __init__(self, max_workers):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers, thread_name_prefix="file-io")
+        self._done = collections.deque()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+
+    def fileno(self):
+        return self._wakeup_r.fileno()
+
+    def submit(self, fn, args, callback):
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(lambda future: self._complete(future, callback))
+
+    def _complete(self, future, callback):
+        # Runs in the I/O thread
+        self._done.append((future, callback))
+        try:
+            self._wakeup_w.send(b"\0")
+        except BlockingIOError:
+            # The wakeup socket is full, the loop is going to wake up anyway
+            pass
+
+    def process_events(self, mask):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._done:
+            future, callback = self._done.popleft()
+            try:
+                callback(future)
+            except Exception:
+                log.exception('I/O callback exception')
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+
+
+class LoopStallMonitor:
+    """Tracks for how long the event loop was kept from serving sockets.
+
+    The selector engine records the busy time of every loop iteration,
+    the asyncio engine the lateness of a periodic heartbeat.
+    """
+
+    def __init__(self, threshold=0.05):
+        self.threshold = threshold
+        self.iterations = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.stalls = 0
+
+    def record(self, duration):
+        self.iterations += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        if duration > self.threshold:
+            self.stalls += 1
+            log.warning('event loop stalled for %.1f ms', duration * 1000)
+
+    def stats(self):
+        return dict(iterations=self.iterations, stalls=self.stalls,
+                    max_ms=round(self.max * 1000, 3),
+                    avg_ms=round(self.total * 1000 / max(self.iterations, 1), 3))
+
+
+class ConnectionLimit:
+    """Admission control: open connections of a worker and of all workers.
+
+    A connection counts from accept to HTTPConnection.close(). Accepting
+    pauses once max_connections of the worker or max_total of all workers
+    are open, 0 - no limit, and resumes when both are below low_watermark
+    of their limit. Workers publish their counts in a shared RawArray,
+    allocated before fork, the total may overshoot by one per worker.
+    """
+
+    def __init__(self, workers=1, max_connections=0, max_total=0, low_watermark=0.9):
+        self.max_connections = max_connections
+        self.max_total = max_total
+        self.low_watermark = low_watermark
+        self.counts = multiprocessing.RawArray('q', max(workers, 1))
+        self.worker_id = 0
+        self.open = 0
+        self.paused = False
+        self.pauses = 0
+        # Accepting stays paused until then after running out of descriptors
+        self.resume_at = 0.0
+        # Set by the engine, called with True to stop accepting, False to resume
+        self.on_pause = None
+
+    def attach(self, worker_id):
+        self.worker_id = worker_id
+        # Connections of a previous worker with this id are gone with it
+        self.counts[worker_id] = 0
+
+    def _reached(self, fraction):
+        if self.max_connections and self.open >= self.max_connections * fraction:
+            return True
+        return bool(self.max_total) and sum(self.counts) >= self.max_total * fraction
+
+    def opened(self):
+        self.open += 1
+        self.counts[self.worker_id] = self.open
+        if not self.paused and self._reached(1.0):
+            log.warning('worker %d: %d connections open, accepting paused',
+                        self.worker_id, self.open)
+            self._set_paused(True)
+
+    def closed(self):
+        self.open -= 1
+        self.counts[self.worker_id] = self.open
+        if self.paused:
+            self.check(time.monotonic())
+
+    def accept_failed(self, now, delay=1.0):
+        """accept() ran out of descriptors or memory, retry after delay."""
+        self.resume_at = now + delay
+        if not self.paused:
+            self._set_paused(True)
+
+    def check(self, now):
+        """Resume accepting if possible, called on every close and by the
+        event loop while paused, for connections closed by other workers."""
+        if self.paused and now >= self.resume_at and not self._reached(self.low_watermark):
+            log.info('worker %d: %d connections open, accepting resumed',
+                     self.worker_id, self.open)
+            self._set_paused(False)
+
+    def _set_paused(self, paused):
+        self.paused = paused
+        if paused:
+            self.pauses += 1
+        if self.on_pause is not None:
+            self.on_pause(paused)
+
+    def stats(self):
+        return dict(open=self.open, total=sum(self.counts), pauses=self.pauses)
 
 
 class Message:
-    def __init__(self, selector, sock, addr, rootdir):
+    """Selector engine: drives an HTTPConnection over a non-blocking socket."""
+
+    # Every connection of a worker receives into this buffer, one at a time
+    recv_buffer = memoryview(bytearray(65536))
+
+    def __init__(self, selector, sock, addr, connection):
         self.selector = selector
         self.sock = sock
         self.addr = addr
-        self._recv_buffer = b''
-        self._send_buffer = b''
-        self.method = None
-        self.uri = None
-        self.request = None
-        self.response_created = False
-
-        self.request_processor = HTTPRequestProcessor(rootdir)
+        self.connection = connection
+        self.connection.on_response_ready = self._response_ready
+        self.connection.on_timeout = self.close
+        self._events = selectors.EVENT_READ
 
     def _set_selector_events_mask(self, mode):
-        """Set selector to listen for events: mode is 'r', 'w', or 'rw'."""
-        if mode == 'r':
+        """Set selector to listen for events: mode is 'r', 'w', 'rw' or ''
+        to stop listening until the connection can make progress again."""
+        if mode == '':
+            events = 0
+        elif mode == 'r':
             events = selectors.EVENT_READ
         elif mode == 'w':
             events = selectors.EVENT_WRITE
@@ -29,199 +537,754 @@ class Message:
             events = selectors.EVENT_READ | selectors.EVENT_WRITE
         else:
             raise ValueError(f'Invalid events mask mode {repr(mode)}.')
-        self.selector.modify(self.sock, events, data=self)
+        if events == self._events:
+            return
+        if not events:
+            self.selector.unregister(self.sock)
+        elif not self._events:
+            self.selector.register(self.sock, events, data=self)
+        else:
+            self.selector.modify(self.sock, events, data=self)
+        self._events = events
+
+    def _update_events(self):
+        reading = self.connection.reading_allowed
+        responses = self.connection.responses
+        # Waiting for writability makes sense only when the next response is built
+        writing = bool(responses) and responses[0].ready
+        if reading and writing:
+            self._set_selector_events_mask('rw')
+        elif writing:
+            self._set_selector_events_mask('w')
+        elif reading:
+            self._set_selector_events_mask('r')
+        else:
+            # Waiting for an I/O thread with a full queue or a half-closed socket
+            self._set_selector_events_mask('')
+
+    def _response_ready(self):
+        if self.sock is not None:
+            self._update_events()
 
     def _read(self):
         try:
             # Should be ready to read
-            data = self.sock.recv(4096)
+            size = self.sock.recv_into(self.recv_buffer)
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         else:
-            if data:
-                self._recv_buffer += data
+            if size:
+                # The parser copies the data out before the next recv_into()
+                self.connection.feed(self.recv_buffer[:size])
             else:
-                raise RuntimeError('Peer closed.')
+                self.connection.eof()
 
     def _write(self):
-        if self._send_buffer:
-            print('sending', repr(self._send_buffer), 'to', self.addr)
+        responses = self.connection.responses
+        while responses and responses[0].ready:
+            response = responses[0]
             try:
-                # Should be ready to write
-                sent = self.sock.send(self._send_buffer)
+                if response.segments:
+                    self._send_segments(responses)
+                # Headers are out, the socket is likely still writable for the body
+                if not response.segments and response.body is not None and not response.body.done:
+                    response.body.send(self.sock)
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
-                pass
-            else:
-                self._send_buffer = self._send_buffer[sent:]
-                # Close when the buffer is drained. The response has been sent.
-                if sent and not self._send_buffer:
+                return
+            self.connection.sent(time.monotonic())
+            if not response.done:
+                # Partial write, wait until the socket is writable again
+                return
+            # One sendmsg() may have finished several pipelined responses
+            while responses and responses[0].done:
+                if not self.connection.finish_response():
                     self.close()
+                    return
+
+    def _send_segments(self, responses):
+        """Send the heads and in-memory bodies of the ready responses at the
+        front of the queue with one sendmsg(), up to the first response
+        whose body is sent on its own."""
+        segments = []
+        flags = 0
+        for response in responses:
+            if not response.ready:
+                break
+            segments += response.segments
+            body = response.body
+            if body is not None:
+                if isinstance(body, FileBody) and not body.done:
+                    flags = MSG_MORE
+                break
+            if len(segments) >= SEND_SEGMENTS:
+                break
+        log.debug('sending %d segments to %s', len(segments), self.addr)
+        # Should be ready to write
+        sent = self.sock.sendmsg(segments, (), flags)
+        for response in responses:
+            if not sent:
+                return
+            segments = response.segments
+            while segments and len(segments[0]) <= sent:
+                sent -= len(segments.pop(0))
+            if segments and sent:
+                # Only the view moves, the bytes stay where they are
+                segments[0] = memoryview(segments[0])[sent:]
+                return
 
     def process_events(self, mask):
         if mask & selectors.EVENT_READ:
             self.read()
-        if mask & selectors.EVENT_WRITE:
+        if mask & selectors.EVENT_WRITE and self.sock is not None:
             self.write()
 
     def read(self):
         self._read()
-        if self.request is None:
-            self.process_request()
+        self.process_requests()
 
     def write(self):
-        if self.request:
-            if not self.response_created:
-                self.create_response()
         self._write()
+        # Freed queue slots let buffered pipelined requests in
+        self.process_requests()
+
+    def process_requests(self):
+        if self.sock is None:
+            return
+        self.connection.process_requests()
+        if self.connection.finished:
+            self.close()
+            return
+        self._update_events()
 
     def close(self):
-        print('closing connection to', self.addr)
+        log.debug('closing connection to %s', self.addr)
+        self.connection.close()
         try:
-            self.selector.unregister(self.sock)
+            if self._events:
+                self.selector.unregister(self.sock)
         except Exception as e:
-            print(f'error: selector.unregister() exception for',
-                  f'{self.addr}: {repr(e)}')
+            log.error('selector.unregister() exception for %s: %r', self.addr, e)
 
         try:
             self.sock.close()
         except OSError as e:
-            print(f'error: socket.close() exception for',
-                  f'{self.addr}: {repr(e)}')
+            log.error('socket.close() exception for %s: %r', self.addr, e)
         finally:
             # Delete reference to socket object for garbage collection
             self.sock = None
 
-    def process_request(self):
-        self.request = self._recv_buffer
-        print("request = %s" % self.request)
-        self._set_selector_events_mask('w')
 
-    def create_response(self):
-        response = self._create_response(self.request)
-        message = response
-        self.response_created = True
-        self._send_buffer += message
+class FileBody:
+    """Response body sent from an open file with os.sendfile, without
+    reading it into memory."""
+
+    supported = hasattr(os, "sendfile")
+
+    def __init__(self, path, offset=0, count=None):
+        self.file = open(path, "rb")
+        self.offset = offset
+        if count is None:
+            count = os.fstat(self.file.fileno()).st_size - offset
+        self.remaining = count
+
+    @property
+    def done(self):
+        return self.remaining <= 0
+
+    def send(self, sock):
+        sent = os.sendfile(sock.fileno(), self.file.fileno(), self.offset, self.remaining)
+        if not sent:
+            raise RuntimeError(f'File {self.file.name} was truncated while sending.')
+        self.offset += sent
+        self.remaining -= sent
+        return sent
+
+    def close(self):
+        self.file.close()
+
+
+class FileSlice:
+    """File-like reader of count bytes of a file starting at offset."""
+
+    def __init__(self, path, offset, count):
+        self.file = open(path, "rb")
+        self.file.seek(offset)
+        self.remaining = count
+
+    def read(self, size):
+        data = self.file.read(min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class StreamBody:
+    """Response body pulled from a source only while the socket accepts
+    data, so a connection never buffers more than high_watermark bytes.
+
+    source is a file-like object read in chunk_size pieces or any iterable
+    of bytes (e.g. transformed content). With chunked=True the body is framed
+    with Transfer-Encoding: chunked for sources of unknown length.
+    """
+
+    def __init__(self, source, chunk_size=65536, low_watermark=65536,
+                 high_watermark=131072, chunked=False):
+        self.source = source
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.chunked = chunked
+        if hasattr(source, "read"):
+            self._chunks = iter(lambda: source.read(chunk_size), b"")
+        else:
+            self._chunks = iter(source)
+        self.buffer = bytearray()
+        self.exhausted = False
+
+    @property
+    def done(self):
+        return self.exhausted and not self.buffer
+
+    def _fill(self):
+        # Refill only below the low watermark, stop at the high one
+        if self.exhausted or len(self.buffer) >= self.low_watermark:
+            return
+        while len(self.buffer) < self.high_watermark:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self.exhausted = True
+                if self.chunked:
+                    self.buffer += b"0\r\n\r\n"
+                return
+            if not chunk:
+                continue
+            if self.chunked:
+                self.buffer += b"%x\r\n" % len(chunk)
+                self.buffer += chunk
+                self.buffer += b"\r\n"
+            else:
+                self.buffer += chunk
+
+    def send(self, sock):
+        self._fill()
+        if not self.buffer:
+            return 0
+        sent = sock.send(self.buffer)
+        del self.buffer[:sent]
+        return sent
+
+    def pull(self):
+        """Take the buffered bytes, for engines writing to a transport."""
+        self._fill()
+        data, self.buffer = self.buffer, bytearray()
+        return data
+
+    def close(self):
+        close = getattr(self.source, "close", None)
+        if close is not None:
+            close()
+
+
+class ErrorResponseTable:
+    """Error pages read once from error_templates with every header except
+    Date and Connection rendered in advance.
+
+    Built before the workers are forked, so they all share one copy.
+    reload() re-reads the templates, e.g. from a SIGHUP handler.
+    """
+
+    template_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "error_templates")
+    _default = None
 
-    def _create_response(self, request):
-        return self.request_processor.create_response_for_message(request)
+    def __init__(self, responsecode=RESPONSE_CODES, version="HTTP/1.1",
+                 server="OTUServer", template_dir=None):
+        self.responsecode = responsecode
+        self.version = version
+        self.server = server
+        if template_dir is not None:
+            self.template_dir = template_dir
+        self.responses = {}
+        self.reload()
+
+    @classmethod
+    def default(cls):
+        if cls._default is None:
+            cls._default = cls()
+        return cls._default
+
+    def reload(self):
+        responses = {}
+        for code, reason in self.responsecode.items():
+            if code < "400":
+                continue
+            path = os.path.join(self.template_dir, f"{code}.html")
+            try:
+                with open(path, "rb") as error_file:
+                    body = error_file.read()
+            except FileNotFoundError:
+                body = b""
+            head = (f'{self.version} {code} {reason}\r\n'
+                    f'Server: {self.server}\r\n'
+                    f'Content-Length: {len(body)}\r\n'
+                    f'Content-Type: {mimetypes.guess_type(path)[0]}\r\n')
+            responses[code] = (head.encode("utf-8"), body)
+        # Swap the whole table at once, a response is never built from a mix
+        self.responses = responses
+
+    def render(self, method, responsecode, date, keep_alive, headers=b""):
+        """date is the encoded Date header line, see HTTPDate, headers are
+        extra encoded header lines. A HEAD gets the Content-Length of the
+        page without the page."""
+        head, body = self.responses[responsecode]
+        if method == "HEAD":
+            body = b""
+        return b"".join([head, headers, date, CONNECTION_HEADERS[keep_alive], b"\r\n"]), body
+
+
+class FileJob:
+    """File-system work left for a GET or HEAD after the URI was checked."""
+    __slots__ = ("request", "method", "path", "cache_key", "keep_alive", "gzip", "fs_calls",
+                 "resolved", "path_key")
+
+    def __init__(self, request, path, cache_key, keep_alive, gzip=False, resolved=None,
+                 path_key=None):
+        # Conditional request headers are evaluated in load_file
+        self.request = request
+        self.method = request.method
+        self.path = path
+        self.cache_key = cache_key
+        self.keep_alive = keep_alive
+        # The client accepts a gzip variant
+        self.gzip = gzip
+        # os.stat and open calls of load_file, for the metrics
+        self.fs_calls = 0
+        # http_cache.ResolvedPath from the path cache, or set by load_file
+        self.resolved = resolved
+        # Key of the path cache entry to fill, None after a hit
+        self.path_key = path_key
+
+
+class FileResult:
+    """Outcome of HTTPRequestProcessor.load_file."""
+    __slots__ = ("responsecode", "path", "stat", "body", "content_range", "content_type",
+                 "validators", "encoding", "length")
+
+    def __init__(self, responsecode, path=None, stat=None, body=b"", content_range=None,
+                 content_type=None, validators=None, encoding=None, length=None):
+        self.responsecode = responsecode
+        self.path = path
+        self.stat = stat
+        self.body = body
+        # (first, last) of a 206 or 416 response
+        self.content_range = content_range
+        self.content_type = content_type
+        # ETag and Last-Modified
+        self.validators = validators
+        # Content coding of the body and its length, None for the file as is
+        self.encoding = encoding
+        self.length = length
+
+    def close(self):
+        if not isinstance(self.body, bytes):
+            self.body.close()
+
+
+class Response:
+    """A response of HTTPRequestProcessor with its own headers.
+
+    head is the encoded status line and header block, rendered by the
+    processor, body is bytes, a FileBody or a StreamBody.
+    """
+    __slots__ = ("responsecode", "headers", "head", "body", "keep_alive")
+
+    def __init__(self, responsecode, headers, head, body, keep_alive):
+        self.responsecode = responsecode
+        self.headers = headers
+        self.head = head
+        self.body = body
+        self.keep_alive = keep_alive
 
 
 class HTTPRequestProcessor:
+    """Turns parsed requests into Response objects.
+
+    It keeps no per-request state, so one processor serves every
+    connection of a worker, including requests finished in I/O threads.
+    """
+
+    version = "HTTP/1.1"
+    server = "OTUServer"
+    supported_methods = ("GET", "HEAD")
+    uri_pattern = re.compile(r"^\/[\/\.a-zA-Z0-9\-\_\%]*$")
+
+    def __init__(self, rootdir, use_sendfile=True, chunk_size=65536,
+                 low_watermark=65536, high_watermark=131072, file_cache=None,
+                 error_responses=None, date=None, gzip_static=True, gzip_cache=None,
+                 metrics_path=None, path_cache=None):
+        self.responsecode = RESPONSE_CODES
+        self.rootdir = os.path.normpath(os.path.abspath(rootdir))
+        self.root_prefix = os.path.join(self.rootdir, '')
+        # Status line and Server header of each code, encoded once
+        self.status_lines = {
+            code: f'{self.version} {code} {reason}\r\nServer: {self.server}\r\n'.encode("utf-8")
+            for code, reason in self.responsecode.items()
+        }
+        # Refreshed by the event loop of the worker
+        self.date = date or HTTPDate()
+        self.use_sendfile = use_sendfile and FileBody.supported
+        self.stream_options = dict(chunk_size=chunk_size,
+                                   low_watermark=low_watermark,
+                                   high_watermark=high_watermark)
+        # http_cache.LRUFileCache shared by all connections of a worker
+        self.file_cache = file_cache
+        # http_cache.PathCache of the worker, filled by the event loop only
+        self.path_cache = path_cache
+        self.error_responses = error_responses or ErrorResponseTable.default()
+        # Serve file.gz variants, compress the rest into http_gzip.GzipCache
+        self.gzip_static = gzip_static
+        self.gzip_cache = gzip_cache
+        self.gzip = gzip_static or gzip_cache is not None
+        # Answered with http_metrics.metrics, None - no metrics endpoint
+        self.metrics_path = metrics_path
+
+    def start_response(self, request, keep_alive=False):
+        """Everything that doesn't touch the disk. Returns the Response or a
+        FileJob to be run with load_file, possibly in an I/O thread."""
+        if isinstance(request, http_parser.HTTPParseError):
+            # Closed after the response, the method doesn't matter
+            return self.create_response_not_200(None, request.responsecode, False)
+        if request.method not in self.supported_methods:
+            # A request body of an unsupported method is never read
+            return self.create_response_not_200(request.method, "405", False)
+        if self.metrics_path is not None and request.target.startswith(self.metrics_path):
+            if request.target.partition("?")[0] == self.metrics_path:
+                return self.create_response_metrics(request, keep_alive)
+        return self.validate_uri(request, keep_alive)
+
+    def create_response_not_200(self, method, responsecode, keep_alive, headers=b""):
+        head, body = self.error_responses.render(method, responsecode, self.date.header,
+                                                 keep_alive, headers)
+        return Response(responsecode, None, head, body, keep_alive)
+
+    def create_response_metrics(self, request, keep_alive):
+        body = metrics.render().encode("utf-8")
+        headers = {'Content-Length': len(body),
+                   'Content-Type': http_metrics.CONTENT_TYPE,
+                   'Cache-Control': 'no-store'}
+        return self._create_response("200", headers, body if request.method == "GET" else b"",
+                                     keep_alive)
 
-    def __init__(self, rootdir):
-        self.responsecode = {"200": "OK",
-                             "500": "Internal sever Error",
-                             "405": "Method Unsupported",
-                             "403": "Access Denied",
-                             "404": "Resource Not Fund",
-                             }
-        self.rootdir = rootdir
-        # Date, Server, Content‐Length, Content‐Type, Connection
-        self.headers = dict(Server='OTUServer')
-        self.version = "HTTP/1.1"
-        self.supported_methods = ["GET", "HEAD"]
-        self.uri_pattern = re.compile(r"^\/[\/\.a-zA-Z0-9\-\_\%]*$")
-
-    def create_response_for_message(self, request):
+    def load_file(self, job):
+        """Blocking file-system part of a response, thread-safe."""
+        path = job.path
         try:
-            processed_str = request.decode("utf-8")
-        except UnicodeDecodeError:
-            return self.create_response_not_200("500")
-        method, uri, *_ = processed_str.split(" ")
-        if method not in self.supported_methods:
-            return self.create_response_not_200("405")
-        if method.upper() == "GET":
-            response = self.validate_uri(method, uri)
+            resolved = job.resolved
+            if resolved is None:
+                resolved = job.resolved = self.resolve_path(job)
+            if resolved.responsecode is not None:
+                return FileResult(resolved.responsecode)
+            path, stat, validators = resolved.path, resolved.stat, resolved.validators
+            content_type, encoding, variant = (resolved.content_type, resolved.encoding,
+                                               resolved.variant)
+            if self.not_modified(job.request, *validators):
+                # Answered from the stat, the file is never opened
+                return FileResult("304", path, stat, content_type=content_type,
+                                  validators=validators, encoding=encoding)
+            if encoding is not None:
+                if variant is None:
+                    # A HEAD needs the length too, compressed once and then
+                    # a hit of the cache
+                    body = self.gzip_cache.compress(path, validators[0])
+                    length = len(body)
+                    if job.method != "GET":
+                        body = b""
+                else:
+                    length = variant.st_size
+                    body = self._load_body(job, path + http_gzip.SUFFIX, length)
+                return FileResult("200", path, stat, body, None, content_type, validators,
+                                  encoding, length)
+            if job.method == "GET":
+                content_range = self.requested_range(job.request, stat.st_size, *validators)
+                if content_range is not None:
+                    return self._load_range(job, path, stat, content_type, validators,
+                                            *content_range)
+            body = self._load_body(job, path, stat.st_size)
+            return FileResult("200", path, stat, body, None, content_type, validators)
+        except (FileNotFoundError, NotADirectoryError):
+            return FileResult("404")
+        except Exception:
+            log.exception('can not load %s', path)
+            return FileResult("500")
+
+    def resolve_path(self, job):
+        """os.stat of the file or the index.html of a directory, and of its
+        gzip variant, thread-safe. Returns an http_cache.ResolvedPath."""
+        path = job.path
+        try:
+            job.fs_calls += 1
+            stat = os.stat(path)
+            if S_ISDIR(stat.st_mode):
+                path = os.path.join(path, 'index.html')
+                job.fs_calls += 1
+                stat = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return http_cache.ResolvedPath("404")
+        if not S_ISREG(stat.st_mode):
+            return http_cache.ResolvedPath("404")
+        content_type = mimetypes.guess_type(path)[0]
+        size = stat.st_size
+        encoding = variant = None
+        validated = stat
+        if job.gzip and http_gzip.compressible(content_type, size):
+            job.fs_calls += 1
+            variant = http_gzip.fresh_variant(path, stat)
+            if variant is not None:
+                encoding = "gzip"
+                # The ETag tells the written variant from one compressed on the fly
+                validated = variant
+            elif self.gzip_cache is not None and size <= self.gzip_cache.max_file_size:
+                encoding = "gzip"
+        validators = file_validators(validated.st_mtime_ns, validated.st_size, encoding)
+        return http_cache.ResolvedPath(None, path, stat, content_type, encoding, variant,
+                                       validators, job.cache_key)
+
+    def _load_body(self, job, path, size):
+        if job.method != "GET":
+            return b""
+        job.fs_calls += 1
+        # No more than size, the Content-Length: the stat may be from the
+        # path cache and the file rewritten since
+        if self.file_cache is not None and size <= self.file_cache.max_file_size:
+            with open(path, "rb") as cached_file:
+                return self._read_exactly(cached_file, size)
+        if self.use_sendfile:
+            return FileBody(path, 0, size)
+        if size > self.stream_options['chunk_size']:
+            return StreamBody(FileSlice(path, 0, size), **self.stream_options)
+        with open(path, "rb") as error_file:
+            return self._read_exactly(error_file, size)
+
+    @staticmethod
+    def _read_exactly(file, size):
+        body = file.read(size)
+        if len(body) < size:
+            raise RuntimeError(f'File {file.name} was truncated while reading.')
+        return body
+
+    def _load_range(self, job, path, stat, content_type, validators, first, last):
+        """Open or read only the requested bytes of the file."""
+        if first > last:
+            return FileResult("416", path, stat)
+        job.fs_calls += 1
+        count = last - first + 1
+        if self.use_sendfile:
+            body = FileBody(path, first, count)
+        elif count > self.stream_options['chunk_size']:
+            body = StreamBody(FileSlice(path, first, count), **self.stream_options)
         else:
-            response = self.validate_uri(method, uri)
-        return response
-
-    def create_response_not_200(self, responsecode):
-        self._flush_headers()
-        send_mesg = self._format_response_head(responsecode)
-        print("Sended message %s" % send_mesg)
-        with open(f"error_templates/{responsecode}.html", 'rb') as error_file:
-            body = error_file.read()
-        self.headers['Content-Length'] = self.get_file_size(f"error_templates/{responsecode}.html")
-        self.headers['Content‐Type'] = mimetypes.guess_type(f"error_templates/{responsecode}.html")[0]
-        self.headers['Connection'] = "close"
-        response = send_mesg.encode("utf-8") + body
-        return response
-
-    def create_response_200(self, method, uri="error_templates/404.html"):
-        # self._flush_headers()
+            with open(path, "rb") as range_file:
+                range_file.seek(first)
+                body = range_file.read(count)
+        return FileResult("206", path, stat, body, (first, last), content_type, validators)
+
+    def finish_file_response(self, job, result):
+        if job.path_key is not None and job.resolved is not None and result.responsecode != "500":
+            self.path_cache.put(job.path_key, job.resolved, time.monotonic())
+        if result.responsecode == "416":
+            return self.create_response_range_not_satisfiable(result.stat.st_size, job.keep_alive)
+        if result.responsecode not in ("200", "206", "304"):
+            keep_alive = job.keep_alive and result.responsecode != "500"
+            return self.create_response_not_200(job.method, result.responsecode, keep_alive)
+        size = result.stat.st_size
+        content_type, encoding = result.content_type, result.encoding
+        etag, last_modified = result.validators
+        vary = self._varies(content_type, size, encoding)
+        if result.responsecode == "304":
+            return self.create_response_not_modified(etag, last_modified, vary, job.keep_alive)
+        if result.responsecode == "206":
+            return self.create_response_partial(content_type, size, etag, last_modified, vary,
+                                                result.content_range, result.body,
+                                                job.keep_alive)
+        if isinstance(result.body, bytes) and result.body and self.file_cache is not None:
+            cached = self.file_cache.add(job.cache_key, result.path, result.body, content_type,
+                                         result.stat, time.monotonic(), etag, last_modified,
+                                         encoding)
+            return self.create_response_cached(job.request, cached, job.keep_alive)
+        length = size if result.length is None else result.length
+        headers = self._entity_headers(content_type, length, etag, last_modified, vary, encoding)
+        return self._create_response("200", headers, result.body, job.keep_alive)
+
+    def create_response_cached(self, request, cached, keep_alive):
+        vary = self._varies(cached.content_type, cached.source_size, cached.encoding)
+        if self.not_modified(request, cached.etag, cached.last_modified):
+            return self.create_response_not_modified(cached.etag, cached.last_modified, vary,
+                                                     keep_alive)
         body = b""
-        self.headers['Content-Length'] = self.get_file_size(uri)
-        self.headers["Content-Type"] = mimetypes.guess_type(uri)[0]
-        self.headers['Connection'] = "close"
-        if method == "GET":
-            with open(uri, "rb") as error_file:
-                body = error_file.read()
-        send_mesg = self._format_response_head("200")
-        response = send_mesg.encode("utf-8") + body
-        return response
-
-    def validate_uri(self, method, uri):
-        try:
-            if "../" in uri:
-                return self.create_response_not_200("403")
-            # Split ? and #
-            uri = uri.split("#")[0].split("?")[0]
-            if not self.uri_pattern.match(uri):
-                return self.create_response_not_200("403")
-            # understand spaces и %XX in filename
-            uri = self.unquote_uri(uri)
-            uri = os.path.join(self.rootdir, uri.lstrip('/'))
-            if os.path.isdir(uri):
-                uri = os.path.join(uri, 'index.html')
-            if not os.path.isfile(uri):
-                return self.create_response_not_200("404")
-            # print(uri)
-            response = self.create_response_200(method=method, uri=uri)
-            return response
-        except Exception as e:
-            print(repr(e))
-            return self.create_response_not_200("500")
-
-    def _format_response_head(self, responsecode):
-        response_string = self.responsecode[responsecode]
-        version = self.version
-        response_code_header_str = f'{" ".join([version, responsecode, response_string])}\r\n'
-        headers = self._create_headers()
-        if headers:
-            response_code_header_str = f'{response_code_header_str}{headers}\r\n\r\n'
-        return response_code_header_str
-
-    def _create_headers(self):
-        self.headers['Date'] = self._create_timestamp()
-        temp_headers = [f'{key}: {value}' for key, value in self.headers.items()]
-        headers = "\r\n".join(temp_headers)
-        return headers
+        if request.method == "GET":
+            content_range = None
+            if cached.encoding is None:
+                content_range = self.requested_range(request, cached.size, cached.etag,
+                                                     cached.last_modified)
+            if content_range is not None:
+                first, last = content_range
+                if first > last:
+                    return self.create_response_range_not_satisfiable(cached.size, keep_alive)
+                return self.create_response_partial(cached.content_type, cached.size,
+                                                    cached.etag, cached.last_modified, vary,
+                                                    content_range, cached.body[first:last + 1],
+                                                    keep_alive)
+            body = cached.body
+        headers = self._entity_headers(cached.content_type, cached.size, cached.etag,
+                                       cached.last_modified, vary, cached.encoding)
+        return self._create_response("200", headers, body, keep_alive)
+
+    def _varies(self, content_type, size, encoding):
+        """The response depends on Accept-Encoding."""
+        return encoding is not None or self.gzip and http_gzip.compressible(content_type, size)
 
     @staticmethod
-    def _create_timestamp():
-        return datetime.datetime.strftime(datetime.datetime.now(), "%d %b %Y %H:%M")
+    def _entity_headers(content_type, length, etag, last_modified, vary, encoding=None):
+        headers = {'Content-Length': length,
+                   'Content-Type': content_type}
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        if vary:
+            headers['Vary'] = 'Accept-Encoding'
+        headers['Accept-Ranges'] = 'bytes'
+        headers['ETag'] = etag
+        headers['Last-Modified'] = last_modified
+        return headers
+
+    def create_response_partial(self, content_type, size, etag, last_modified, vary,
+                                content_range, body, keep_alive):
+        first, last = content_range
+        headers = {'Content-Length': last - first + 1,
+                   'Content-Type': content_type,
+                   'Content-Range': f'bytes {first}-{last}/{size}'}
+        if vary:
+            headers['Vary'] = 'Accept-Encoding'
+        headers['ETag'] = etag
+        headers['Last-Modified'] = last_modified
+        return self._create_response("206", headers, body, keep_alive)
+
+    def create_response_range_not_satisfiable(self, size, keep_alive):
+        # Only a GET asks for a range
+        return self.create_response_not_200("GET", "416", keep_alive,
+                                            b"Content-Range: bytes */%d\r\n" % size)
+
+    def create_response_not_modified(self, etag, last_modified, vary, keep_alive):
+        headers = {'ETag': etag, 'Last-Modified': last_modified}
+        if vary:
+            headers['Vary'] = 'Accept-Encoding'
+        return self._create_response("304", headers, b"", keep_alive)
 
-    def _flush_headers(self):
-        self.headers = dict(Server='OTUServer')
+    @staticmethod
+    def not_modified(request, etag, last_modified):
+        """If-None-Match, or If-Modified-Since when it is absent (RFC 7232 6)."""
+        if_none_match = request.header("if-none-match")
+        if if_none_match is not None:
+            for tag in if_none_match.split(","):
+                tag = tag.strip()
+                # Weak comparison, a GET may be answered from a weak match
+                if tag == "*" or tag == etag or tag[2:] == etag and tag[:2] == "W/":
+                    return True
+            return False
+        if_modified_since = request.header("if-modified-since")
+        if if_modified_since is None:
+            return False
+        # Both dates have a one second resolution
+        return if_modified_since == last_modified or _parse_http_date(
+            if_modified_since) >= _parse_http_date(last_modified)
 
     @staticmethod
-    def get_file_size(uri):
-        return os.path.getsize(uri)
+    def requested_range(request, size, etag, last_modified):
+        """Range of a GET to serve as 206 or 416, None for the whole file."""
+        value = request.header("range")
+        if value is None:
+            return None
+        if_range = request.header("if-range")
+        if if_range is not None:
+            # Strong comparison of the entity tag, or the exact date
+            if if_range[:1] == '"' or if_range[:2] == "W/":
+                if if_range != etag:
+                    return None
+            elif _parse_http_date(if_range) != _parse_http_date(last_modified):
+                return None
+        return byte_range(value, size)
+
+    def validate_uri(self, request, keep_alive):
+        # Ranges are served from the file as is
+        gzip = (self.gzip and http_gzip.accepts_gzip(request.header("accept-encoding"))
+                and request.header("range") is None)
+        path_key = None
+        if self.path_cache is not None:
+            path_key = request.target + "\0gzip" if gzip else request.target
+            resolved = self.path_cache.get(path_key, time.monotonic())
+            if resolved is not None:
+                return self.create_response_resolved(request, resolved, keep_alive)
+        uri = request.target
+        if "../" in uri:
+            return self.create_response_forbidden(request, path_key, keep_alive)
+        # Split ? and #
+        uri = uri.split("#")[0].split("?")[0]
+        if not self.uri_pattern.match(uri):
+            return self.create_response_forbidden(request, path_key, keep_alive)
+        # understand spaces и %XX in filename
+        uri = self.unquote_uri(uri)
+        path = os.path.normpath(os.path.join(self.rootdir, uri.lstrip('/')))
+        # %2e%2e segments are dot segments only once unquoted
+        if path != self.rootdir and not path.startswith(self.root_prefix):
+            return self.create_response_forbidden(request, path_key, keep_alive)
+        if uri.endswith('/'):
+            # A file asked for as a directory stays a 404
+            path += '/'
+        uri = path
+        # Clients accepting gzip get their own cache entry: the gzip variant,
+        # or the file as is when it isn't compressible
+        cache_key = uri + "\0gzip" if gzip else uri
+        if self.file_cache is not None:
+            cached = self.file_cache.get(cache_key, time.monotonic())
+            if cached is not None:
+                return self.create_response_cached(request, cached, keep_alive)
+        return FileJob(request, uri, cache_key, keep_alive, gzip, path_key=path_key)
+
+    def create_response_forbidden(self, request, path_key, keep_alive):
+        if path_key is not None:
+            self.path_cache.put(path_key, http_cache.ResolvedPath("403"), time.monotonic())
+        return self.create_response_not_200(request.method, "403", keep_alive)
+
+    def create_response_resolved(self, request, resolved, keep_alive):
+        """Response for a target found in the path cache. Errors and 304s
+        are answered without a system call, files are only opened."""
+        if resolved.responsecode is not None:
+            return self.create_response_not_200(request.method, resolved.responsecode,
+                                                keep_alive)
+        if self.file_cache is not None:
+            cached = self.file_cache.get(resolved.cache_key, time.monotonic())
+            if cached is not None:
+                return self.create_response_cached(request, cached, keep_alive)
+        etag, last_modified = resolved.validators
+        if self.not_modified(request, etag, last_modified):
+            vary = self._varies(resolved.content_type, resolved.stat.st_size, resolved.encoding)
+            return self.create_response_not_modified(etag, last_modified, vary, keep_alive)
+        return FileJob(request, resolved.path, resolved.cache_key, keep_alive,
+                       resolved.encoding is not None, resolved)
+
+    def _create_response(self, responsecode, headers, body, keep_alive):
+        fields = "".join([f'{name}: {value}\r\n' for name, value in headers.items()])
+        head = b"".join([self.status_lines[responsecode], self.date.header,
+                         fields.encode("latin-1"), CONNECTION_HEADERS[keep_alive], b"\r\n"])
+        return Response(responsecode, headers, head, body, keep_alive)
 
     @staticmethod
     def unquote_uri(uri):
         # from urllib.parse lightly changed
-        _hexdig = '0123456789ABCDEFabcdef'
-        _hextobyte = None
-        if _hextobyte is None:
-            _hextobyte = {
-                ("%" + a + b).encode(): bytes([int(a + b, 16)])
-                for a in _hexdig for b in _hexdig
-            }
         uri_encoded = uri.encode()
-        for match, sub in _hextobyte.items():
+        if b"%" not in uri_encoded:
+            return uri
+        for match, sub in _HEXTOBYTE.items():
             uri_encoded = uri_encoded.replace(match, sub)
         return uri_encoded.decode(errors="replace")
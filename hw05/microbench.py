@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks of the server hot path, run one with
+python microbench.py <name>."""
+
+import argparse
+import datetime
+import os
+import socket
+import time
+import timeit
+import tracemalloc
+
+import http_metrics
+import http_parser
+import lib_for_http_server as lib_helper
+
+
+REQUEST = (b"GET /httptest/wikipedia_russia_files/100px-Katun.jpg HTTP/1.1\r\n"
+           b"Host: localhost:8080\r\n"
+           b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:60.0) Gecko/20100101 Firefox/60.0\r\n"
+           b"Accept: image/webp,*/*\r\n"
+           b"Accept-Language: en-US,en;q=0.5\r\n"
+           b"Accept-Encoding: gzip, deflate\r\n"
+           b"Referer: http://localhost:8080/httptest/wikipedia_russia.html\r\n"
+           b"Connection: keep-alive\r\n"
+           b"\r\n")
+
+
+def split_parse(recv_buffer):
+    """Request handling before the incremental parser: find the end of the
+    head, decode everything and split on spaces, scan lines for Connection."""
+    head, _, recv_buffer = recv_buffer.partition(b"\r\n\r\n")
+    method, uri, *_ = head.decode("utf-8").split(" ")
+    request_line, *header_lines = head.split(b"\r\n")
+    connection = None
+    for line in header_lines:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"connection":
+            connection = value.strip().lower()
+    return method, uri, connection
+
+
+def split_header_lookup(head, wanted):
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == wanted:
+            return value.strip()
+
+
+def split_parse_lookups(recv_buffer, names):
+    """split_parse plus the header lookups a conditional, ranged, compressed
+    GET needs, each of them scanning the raw head again."""
+    head = recv_buffer.partition(b"\r\n\r\n")[0]
+    result = split_parse(recv_buffer)
+    return result, [split_header_lookup(head, name) for name in names]
+
+
+def split_parse_segments(segments):
+    recv_buffer = b""
+    for segment in segments:
+        recv_buffer += segment
+        if b"\r\n\r\n" in recv_buffer:
+            return split_parse(recv_buffer)
+
+
+def incremental_parse(segments, parser):
+    for segment in segments:
+        parser.feed(segment)
+        request = parser.next_request()
+        if request is not None:
+            return request
+
+
+def report(name, statement, number):
+    seconds = min(timeit.repeat(statement, number=number, repeat=5))
+    print(f'{name:<44} {seconds / number * 1e9:10.0f} ns/op')
+
+
+def bench_parser(number):
+    whole = [REQUEST]
+    segments = [REQUEST[i:i + 16] for i in range(0, len(REQUEST), 16)]
+    pipelined = REQUEST * 8
+    # A parser lives as long as its connection, keep-alive reuses it
+    parser = http_parser.RequestParser()
+    print(f'request head of {len(REQUEST)} bytes')
+    report('split, one segment', lambda: split_parse_segments(whole), number)
+    report('incremental, one segment', lambda: incremental_parse(whole, parser), number)
+    names = [b"accept-encoding", b"range", b"if-range", b"if-none-match", b"if-modified-since"]
+    report('split, one segment, 5 header lookups', lambda: split_parse_lookups(REQUEST, names), number)
+
+    def incremental_lookups():
+        request = incremental_parse(whole, parser)
+        return [request.header(name.decode()) for name in names]
+
+    report('incremental, one segment, 5 header lookups', incremental_lookups, number)
+    report(f'split, {len(segments)} segments', lambda: split_parse_segments(segments), number)
+    report(f'incremental, {len(segments)} segments', lambda: incremental_parse(segments, parser), number)
+
+    def split_pipelined():
+        recv_buffer = pipelined
+        while recv_buffer:
+            head, _, recv_buffer = recv_buffer.partition(b"\r\n\r\n")
+            split_parse(head + b"\r\n\r\n")
+
+    def incremental_pipelined():
+        parser.feed(pipelined)
+        while parser.next_request() is not None:
+            pass
+
+    report('split, 8 pipelined', split_pipelined, number // 8)
+    report('incremental, 8 pipelined', incremental_pipelined, number // 8)
+
+
+def retained_bytes(factory, count):
+    """Memory held by count live objects made by factory, per object."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [factory() for _ in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return (after - before) / count
+
+
+def format_head_strftime(responsecode, reason, headers):
+    """Response head as built before the Date cache: strftime per
+    response, every header formatted and encoded again."""
+    headers = dict(Server='OTUServer', **headers)
+    headers['Date'] = datetime.datetime.strftime(datetime.datetime.now(), "%d %b %Y %H:%M")
+    status = f'{" ".join(["HTTP/1.1", responsecode, reason])}\r\n'
+    fields = "\r\n".join([f'{key}: {value}' for key, value in headers.items()])
+    return f'{status}{fields}\r\n\r\n'.encode("utf-8")
+
+
+def bench_headers(number):
+    processor = lib_helper.HTTPRequestProcessor(
+        ".", error_responses=lib_helper.ErrorResponseTable.default())
+    headers = {'Content-Length': 35344, 'Content-Type': 'image/jpeg'}
+    report('strftime, formatted head',
+           lambda: format_head_strftime("200", "OK", dict(headers, Connection="keep-alive")),
+           number)
+
+    def cached_date():
+        processor.date.refresh()
+        return processor._create_response("200", dict(headers), b"", True)
+
+    report('cached date, pre-encoded status line', cached_date, number)
+
+
+def bench_alloc(number):
+    """Per-connection cost of a processor per connection, as before the
+    processor became stateless, and of one processor shared by a worker."""
+    options = dict(error_responses=lib_helper.ErrorResponseTable.default())
+    shared = lib_helper.HTTPRequestProcessor(".", **options)
+
+    def per_connection():
+        return lib_helper.HTTPConnection(lib_helper.HTTPRequestProcessor(".", **options))
+
+    def shared_processor():
+        return lib_helper.HTTPConnection(shared)
+
+    count = min(number, 10000)
+    for name, factory in (('processor per connection', per_connection),
+                          ('shared processor', shared_processor)):
+        print(f'{name:<44} {retained_bytes(factory, count):10.0f} bytes/connection')
+        report(name, factory, number)
+
+
+def bench_metrics(number):
+    """Recording cost on the event loop, rendering cost of a scrape."""
+    metrics = http_metrics.Metrics()
+    metrics.setup(4, lib_helper.RESPONSE_CODES)
+    metrics.attach(0)
+    report('observe_response', lambda: metrics.observe_response("200", 1024, 0.0003, 1),
+           number)
+    report('observe_loop', lambda: metrics.observe_loop(0.00007), number)
+    report('publish', metrics.publish, number // 10)
+    report('render, 4 workers', metrics.render, number // 100)
+
+
+class SlowSocket:
+    """Takes at most per_send bytes per send(), like a client reading slowly."""
+
+    def __init__(self, per_send):
+        self.per_send = per_send
+
+    def send(self, data):
+        return min(len(data), self.per_send)
+
+    def sendmsg(self, buffers, ancdata=(), flags=0):
+        return min(sum(map(len, buffers)), self.per_send)
+
+
+def send_sliced(sock, head, body):
+    """Sending as before the segment queue: the body copied behind the
+    head, the rest copied again after every partial send. Returns the
+    bytes copied."""
+    buffer = head + body
+    copied = len(buffer)
+    while buffer:
+        buffer = buffer[sock.send(buffer):]
+        copied += len(buffer)
+    return copied
+
+
+def send_segments(sock, head, body):
+    """Sending as Message does: the head and body gathered by sendmsg(), a
+    partial send leaves a memoryview of the rest. Returns the bytes copied."""
+    segments = [head, body]
+    while segments:
+        sent = sock.sendmsg(segments)
+        while segments and len(segments[0]) <= sent:
+            sent -= len(segments.pop(0))
+        if segments and sent:
+            segments[0] = memoryview(segments[0])[sent:]
+    return 0
+
+
+def bench_buffers(number):
+    """Bytes copied and time per response sent in 64 KiB pieces, bytes
+    copied and time per request received."""
+    processor = lib_helper.HTTPRequestProcessor(
+        ".", error_responses=lib_helper.ErrorResponseTable.default())
+    sock = SlowSocket(65536)
+    for size in (1024, 65536, 1024 * 1024):
+        body = bytes(size)
+        head = processor._create_response(
+            "200", {'Content-Length': size, 'Content-Type': 'text/html'}, body, True).head
+        print(f'{size} byte body: {send_sliced(sock, head, body)} bytes copied sliced, '
+              f'{send_segments(sock, head, body)} with segments')
+        count = max(number * 1024 // size, 10)
+        report(f'sliced buffer, {size} byte body', lambda: send_sliced(sock, head, body), count)
+        report(f'segments, {size} byte body', lambda: send_segments(sock, head, body), count)
+
+    parser = http_parser.RequestParser()
+    head = len(REQUEST) - 4
+    print(f'request of {len(REQUEST)} bytes: {len(REQUEST) + 2 * head} bytes copied with '
+          f'recv() and bytes(head), {len(REQUEST) + head} with recv_into()')
+    client, server = socket.socketpair()
+    view = lib_helper.Message.recv_buffer
+
+    def receive():
+        client.send(REQUEST)
+        parser.feed(server.recv(4096))
+        return parser.next_request()
+
+    def receive_into():
+        client.send(REQUEST)
+        parser.feed(view[:server.recv_into(view)])
+        return parser.next_request()
+
+    report('recv()', receive, number)
+    report('recv_into()', receive_into, number)
+    client.close()
+    server.close()
+
+
+class CountingSocket:
+    """Socket wrapper counting the calls that write to it."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = 0
+
+    def send(self, data):
+        self.calls += 1
+        return self.sock.send(data)
+
+    def sendmsg(self, buffers, ancdata=(), flags=0):
+        self.calls += 1
+        return self.sock.sendmsg(buffers, ancdata, flags)
+
+    def fileno(self):
+        # FileBody.send() takes it for every os.sendfile()
+        self.calls += 1
+        return self.sock.fileno()
+
+
+def bench_writes(number):
+    """Write syscalls and time per response over loopback TCP for an
+    in-memory body, pipelined responses and a file sent with sendfile."""
+    processor = lib_helper.HTTPRequestProcessor(
+        ".", error_responses=lib_helper.ErrorResponseTable.default())
+    listener = socket.create_server(("127.0.0.1", 0))
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    server.setblocking(False)
+    client.setblocking(False)
+    sock = CountingSocket(server)
+    connection = lib_helper.HTTPConnection(processor)
+    message = lib_helper.Message(None, sock, None, connection)
+    path = os.path.abspath(__file__)
+
+    def respond(bodies):
+        for body in bodies:
+            length = body.remaining if isinstance(body, lib_helper.FileBody) else len(body)
+            processed = processor._create_response(
+                "200", {'Content-Length': length, 'Content-Type': 'text/plain'}, body, True)
+            response = lib_helper.QueuedResponse(None, None, True, None, time.monotonic())
+            connection.responses.append(response)
+            connection._fill_response(response, processed)
+        message._write()
+        while True:
+            try:
+                client.recv(1 << 20)
+            except BlockingIOError:
+                break
+
+    cases = (('1 KiB body', lambda: [bytes(1024)]),
+             ('8 pipelined 1 KiB bodies', lambda: [bytes(1024)] * 8),
+             ('file body', lambda: [lib_helper.FileBody(path)]))
+    for name, bodies in cases:
+        count = len(bodies())
+        sock.calls = 0
+        for _ in range(100):
+            respond(bodies())
+        print(f'{name:<44} {sock.calls / (100 * count):10.2f} writes/response')
+        report(name, lambda: respond(bodies()), number // count)
+    client.close()
+    server.close()
+
+
+BENCHMARKS = {
+    'alloc': bench_alloc,
+    'buffers': bench_buffers,
+    'headers': bench_headers,
+    'metrics': bench_metrics,
+    'parser': bench_parser,
+    'writes': bench_writes,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='OTUServer micro-benchmarks')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument(
+        '-n', '--number', type=int, default=20000,
+        help='iterations per measurement, default - 20000'
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    BENCHMARKS[args.benchmark](args.number)
@@ -0,0 +1,495 @@
+import errno
+import os
+import socket
+import tempfile
+import unittest
+
+import gzip
+import http_cache
+import http_gzip
+import http_log
+import http_parser
+import http_timers
+import httpd
+import lib_for_http_server as lib_helper
+
+
+def get_request(**headers):
+    """A parsed GET /, if_none_match stands for the If-None-Match header."""
+    return http_parser.Request("GET", "/", "HTTP/1.1",
+                               {name.replace("_", "-"): value for name, value in headers.items()})
+
+
+def respond(processor, method, target, **headers):
+    """Response of a keep-alive request, its file loaded on the spot."""
+    headers = {name.replace("_", "-"): value for name, value in headers.items()}
+    request = http_parser.Request(method, target, "HTTP/1.1", headers)
+    response = processor.start_response(request, True)
+    if isinstance(response, lib_helper.FileJob):
+        response = processor.finish_file_response(response, processor.load_file(response))
+    return response
+
+
+class Entry:
+    def __init__(self, kind=http_timers.SEND):
+        self.deadline = None
+        self.deadline_kind = kind
+        self.timer_tick = None
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.timers = http_timers.TimerWheel(resolution=0.25, size=16, max_delay=5.0, now=0.0)
+
+    def test_expires_after_deadline(self):
+        entry = Entry()
+        self.timers.schedule(entry, 1.0, 0.0)
+        self.assertEqual([], self.timers.expire(0.9))
+        self.assertEqual([entry], self.timers.expire(1.5))
+        self.assertIsNone(entry.timer_tick)
+        self.assertEqual(0, len(self.timers))
+
+    def test_moved_deadline_is_checked_again(self):
+        entry = Entry()
+        self.timers.schedule(entry, 1.0, 0.0)
+        entry.deadline = 12.0
+        self.assertEqual([], self.timers.expire(1.5))
+        self.assertIsNotNone(entry.timer_tick)
+        # Rechecked at least every max_delay, over more than one revolution
+        self.assertEqual([], self.timers.expire(6.75))
+        self.assertEqual([entry], self.timers.expire(12.5))
+
+    def test_cancel(self):
+        entry = Entry()
+        self.timers.schedule(entry, 1.0, 0.0)
+        self.timers.cancel(entry)
+        self.assertEqual([], self.timers.expire(2.0))
+        self.assertEqual(0, len(self.timers))
+
+    def test_expired_counted_only_when_timed_out(self):
+        entry = Entry()
+        self.timers.schedule(entry, 1.0, 0.0)
+        self.timers.expire(1.5)
+        self.assertEqual(0, self.timers.stats()['send_expired'])
+        self.timers.timed_out(entry)
+        self.assertEqual(1, self.timers.stats()['send_expired'])
+
+
+class ConnectionDeadlineTest(unittest.TestCase):
+    timeouts = {http_timers.HEADER: 10.0, http_timers.SEND: 1.0, http_timers.KEEPALIVE: 2.0}
+
+    def setUp(self):
+        self.timers = http_timers.TimerWheel(resolution=0.25, max_delay=1.0)
+        processor = lib_helper.HTTPRequestProcessor(
+            "doc_root", error_responses=lib_helper.ErrorResponseTable.default())
+        self.jobs = []
+        # The file of the response is never loaded, the connection stays in SEND
+        self.connection = lib_helper.HTTPConnection(
+            processor, submit=lambda fn, args, callback: self.jobs.append(args),
+            timers=self.timers, timeouts=self.timeouts)
+        self.connection.feed(b"GET /httptest/dir2/page.html HTTP/1.1\r\nHost: x\r\n\r\n")
+        self.connection.process_requests()
+        self.assertEqual(http_timers.SEND, self.connection.deadline_kind)
+        self.closed = 0
+
+    def close(self):
+        self.closed += 1
+        self.connection.close()
+
+    def expire(self, now):
+        for connection in self.timers.expire(now):
+            connection.expire(now)
+
+    def test_rearmed_connection_expires_later(self):
+        connection = self.connection
+        start = connection.deadline
+        # The engine still sees progress the first time, then gives up
+        connection.on_timeout = lambda: connection.rearm(start + 0.5)
+        self.expire(start + 0.5)
+        self.assertIsNotNone(connection.timer_tick)
+        self.assertEqual(0, self.timers.stats()['send_expired'])
+
+        connection.on_timeout = self.close
+        self.expire(start + 1.0)
+        self.assertEqual(0, self.closed)
+        self.expire(start + 1.75)
+        self.assertEqual(1, self.closed)
+        self.assertEqual(1, self.timers.stats()['send_expired'])
+        self.assertIsNone(connection.timer_tick)
+
+    def test_keepalive_deadline_after_rearm(self):
+        connection = self.connection
+        start = connection.deadline
+        connection.on_timeout = lambda: connection.rearm(start + 0.5)
+        self.expire(start + 0.5)
+        # The response is done, the connection waits for the next request
+        connection.responses.clear()
+        connection.update_deadline()
+        self.assertEqual(http_timers.KEEPALIVE, connection.deadline_kind)
+        connection.on_timeout = self.close
+        self.expire(connection.deadline + 1.5)
+        self.assertEqual(1, self.closed)
+        self.assertEqual(1, self.timers.stats()['keepalive_expired'])
+
+
+class RequestParserTest(unittest.TestCase):
+    def setUp(self):
+        self.parser = http_parser.RequestParser(max_header_size=256, max_headers=4)
+
+    def parse(self, data):
+        self.parser.feed(data)
+        return self.parser.next_request()
+
+    def assert_rejected(self, responsecode, data):
+        with self.assertRaises(http_parser.HTTPParseError) as raised:
+            self.parse(data)
+        self.assertEqual(responsecode, raised.exception.responsecode)
+
+    def test_pipelined(self):
+        self.parser.feed(b"\r\nGET /a HTTP/1.1\r\nHost: x\r\nAccept: */*\r\n\r\n"
+                         b"HEAD /b HTTP/1.0\r\n\r\nGET /c")
+        first = self.parser.next_request()
+        self.assertEqual(("GET", "/a", "HTTP/1.1"), (first.method, first.target, first.version))
+        self.assertEqual({"host": "x", "accept": "*/*"}, first.headers)
+        second = self.parser.next_request()
+        self.assertEqual(("HEAD", "/b", {}), (second.method, second.target, second.headers))
+        self.assertFalse(second.keep_alive_requested())
+        self.assertIsNone(self.parser.next_request())
+        self.assertEqual(6, len(self.parser))
+
+    def test_trickling_head(self):
+        data = b"\r\n\r\nGET /a HTTP/1.1\r\nHost: x\r\n\r\n"
+        for i in range(len(data) - 1):
+            self.assertIsNone(self.parse(data[i:i + 1]))
+        request = self.parse(data[-1:])
+        self.assertEqual("/a", request.target)
+        self.assertEqual("x", request.header("host"))
+
+    def test_fields(self):
+        request = self.parse(b"GET / HTTP/1.1\r\nAccept:  text/html \t\r\naccept: */*\r\n"
+                             b"If-None-Match: \"A\tb\"\r\nConnection: Close\r\n\r\n")
+        self.assertEqual("text/html, */*", request.header("accept"))
+        self.assertEqual('"A\tb"', request.header("if-none-match"))
+        self.assertIsNone(request.header("range"))
+        self.assertFalse(request.keep_alive_requested())
+
+    def test_too_large(self):
+        self.assert_rejected("431", b"GET /" + b"a" * 300)
+
+    def test_too_large_with_end(self):
+        self.assert_rejected("431", b"GET /" + b"a" * 300 + b" HTTP/1.1\r\n\r\n")
+
+    def test_too_many_fields(self):
+        self.assert_rejected("431", b"GET / HTTP/1.1\r\n" + b"A: b\r\n" * 5 + b"\r\n")
+
+    def test_malformed(self):
+        heads = [b"GET /\r\n\r\n",
+                 b"GET / HTTP/1.1 x\r\n\r\n",
+                 b"G(T / HTTP/1.1\r\n\r\n",
+                 b"GET / HTTP/2.0\r\n\r\n",
+                 b"GET / HTTP/1.1\r\nHost : x\r\n\r\n",
+                 b"GET / HTTP/1.1\r\nHost: x\r\n folded\r\n\r\n",
+                 b"GET / HTTP/1.1\r\nHost\r\n\r\n",
+                 b"GET / HTTP/1.1\r\n: x\r\n\r\n"]
+        for head in heads:
+            with self.subTest(head=head):
+                self.parser = http_parser.RequestParser()
+                self.assert_rejected("400", head)
+
+    def test_control_characters(self):
+        heads = [b"GET /a\nb HTTP/1.1\r\nHost: x\r\n\r\n",
+                 b"GET /a\x00 HTTP/1.1\r\n\r\n",
+                 b"GET / HTTP/1.1\r\nUser-Agent: x\nHost: y\r\n\r\n",
+                 b"GET / HTTP/1.1\r\nUser-Agent: x\rHost: y\r\n\r\n",
+                 b"GET / HTTP/1.1\r\nUser-Agent: x\rHost: y\nA: b\r\n\r\n",
+                 b"GET / HTTP/1.1\r\nUser-Agent: \x1b[2J\r\n\r\n",
+                 b"GET / HTTP/1.1\r\nUser-Agent: \x7f\r\n\r\n"]
+        for head in heads:
+            with self.subTest(head=head):
+                self.parser = http_parser.RequestParser()
+                self.assert_rejected("400", head)
+
+    def test_body_skipped(self):
+        self.parser.feed(b"POST /a HTTP/1.1\r\ncontent-LENGTH: 10\r\n\r\n12345")
+        self.assertEqual("/a", self.parser.next_request().target)
+        self.assertIsNone(self.parser.next_request())
+        request = self.parse(b"67890GET /b HTTP/1.1\r\n\r\n")
+        self.assertEqual("/b", request.target)
+
+    def test_body_fields_rejected(self):
+        self.assert_rejected("400", b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n")
+        self.parser = http_parser.RequestParser()
+        self.assert_rejected("400", b"POST / HTTP/1.1\r\nContent-Length: -1\r\n\r\n")
+        self.parser = http_parser.RequestParser()
+        self.assert_rejected(
+            "400", b"POST / HTTP/1.1\r\nContent-Length: 1\r\nHost : x\r\n\r\n")
+
+
+class ByteRangeTest(unittest.TestCase):
+    etag = '"5b-26"'
+    last_modified = "Sun, 23 Sep 2018 13:43:06 GMT"
+
+    def test_ranges(self):
+        cases = [("bytes=0-9", (0, 9)),
+                 ("bytes=90-", (90, 99)),
+                 ("bytes=90-200", (90, 99)),
+                 ("bytes=-10", (90, 99)),
+                 ("bytes=-200", (0, 99)),
+                 (" Bytes = 5-5 ", (5, 5))]
+        for value, expected in cases:
+            with self.subTest(value=value):
+                self.assertEqual(expected, lib_helper.byte_range(value, 100))
+
+    def test_not_satisfiable(self):
+        for value, size in [("bytes=100-", 100), ("bytes=-0", 100), ("bytes=0-", 0)]:
+            with self.subTest(value=value, size=size):
+                first, last = lib_helper.byte_range(value, size)
+                self.assertGreater(first, last)
+
+    def test_ignored(self):
+        for value in ["items=0-9", "bytes=0-9,20-29", "bytes=9-0", "bytes=-", "bytes=a-9",
+                      "bytes=0-b", "bytes=5", "bytes=+1-2"]:
+            with self.subTest(value=value):
+                self.assertIsNone(lib_helper.byte_range(value, 100))
+
+    def requested_range(self, **headers):
+        request = get_request(**headers)
+        return lib_helper.HTTPRequestProcessor.requested_range(request, 100, self.etag,
+                                                               self.last_modified)
+
+    def test_if_range(self):
+        self.assertIsNone(self.requested_range())
+        self.assertEqual((0, 9), self.requested_range(range="bytes=0-9"))
+        self.assertEqual((0, 9), self.requested_range(range="bytes=0-9", if_range=self.etag))
+        self.assertEqual((0, 9), self.requested_range(range="bytes=0-9",
+                                                      if_range=self.last_modified))
+        # Another entity, or a weak tag that can't be compared strongly
+        self.assertIsNone(self.requested_range(range="bytes=0-9", if_range='"other"'))
+        self.assertIsNone(self.requested_range(range="bytes=0-9", if_range="W/" + self.etag))
+        self.assertIsNone(self.requested_range(range="bytes=0-9",
+                                               if_range="Mon, 24 Sep 2018 13:43:06 GMT"))
+
+
+class NotModifiedTest(unittest.TestCase):
+    etag = '"5b-26"'
+    last_modified = "Sun, 23 Sep 2018 13:43:06 GMT"
+
+    def not_modified(self, **headers):
+        request = get_request(**headers)
+        return lib_helper.HTTPRequestProcessor.not_modified(request, self.etag,
+                                                            self.last_modified)
+
+    def test_if_none_match(self):
+        self.assertFalse(self.not_modified())
+        self.assertTrue(self.not_modified(if_none_match=self.etag))
+        self.assertTrue(self.not_modified(if_none_match=f'"a", W/{self.etag}'))
+        self.assertTrue(self.not_modified(if_none_match="*"))
+        self.assertFalse(self.not_modified(if_none_match='"a", "b"'))
+        # If-Modified-Since is ignored next to If-None-Match
+        self.assertFalse(self.not_modified(if_none_match='"a"',
+                                           if_modified_since=self.last_modified))
+
+    def test_if_modified_since(self):
+        self.assertTrue(self.not_modified(if_modified_since=self.last_modified))
+        self.assertTrue(self.not_modified(if_modified_since="Mon, 24 Sep 2018 00:00:00 GMT"))
+        self.assertFalse(self.not_modified(if_modified_since="Sat, 22 Sep 2018 00:00:00 GMT"))
+        self.assertFalse(self.not_modified(if_modified_since="yesterday"))
+
+
+class PathCacheTest(unittest.TestCase):
+    def test_lru(self):
+        cache = http_cache.PathCache(max_entries=2, ttl=1.0)
+        cache.put("/a", http_cache.ResolvedPath("404"), 0.0)
+        cache.put("/b", http_cache.ResolvedPath(path="b"), 0.0)
+        self.assertIsNotNone(cache.get("/a", 0.5))
+        cache.put("/c", http_cache.ResolvedPath(path="c"), 0.5)
+        self.assertIsNone(cache.get("/b", 0.5))
+        self.assertEqual("c", cache.get("/c", 0.5).path)
+        self.assertEqual(dict(entries=2, hits=1, negative_hits=1, misses=1, hit_rate=0.667,
+                              expirations=0, evictions=1), cache.stats())
+
+    def test_ttl(self):
+        cache = http_cache.PathCache(ttl=1.0)
+        cache.put("/a", http_cache.ResolvedPath("404"), 0.0)
+        self.assertIsNotNone(cache.get("/a", 0.9))
+        self.assertIsNone(cache.get("/a", 1.0))
+        self.assertEqual(1, cache.stats()['expirations'])
+        self.assertEqual(0, len(cache.entries))
+
+    def test_processor(self):
+        with tempfile.TemporaryDirectory() as rootdir:
+            cache = http_cache.PathCache(ttl=60.0)
+            processor = lib_helper.HTTPRequestProcessor(rootdir, use_sendfile=False,
+                                                        path_cache=cache, gzip_static=False)
+            self.assertEqual("404", respond(processor, "GET", "/new.txt").responsecode)
+            with open(os.path.join(rootdir, "new.txt"), "wb") as new_file:
+                new_file.write(b"new")
+            # Trusted until the entry expires
+            self.assertEqual("404", respond(processor, "GET", "/new.txt").responsecode)
+            cache.entries.clear()
+            self.assertEqual(b"new", respond(processor, "GET", "/new.txt").body)
+            response = respond(processor, "GET", "/new.txt")
+            self.assertEqual(("200", b"new"), (response.responsecode, response.body))
+            self.assertEqual(1, cache.stats()['hits'])
+            self.assertEqual("403", respond(processor, "GET", "/../new.txt").responsecode)
+            self.assertEqual("403", respond(processor, "GET", "/../new.txt").responsecode)
+            self.assertEqual(2, cache.stats()['negative_hits'])
+
+
+class GzipTest(unittest.TestCase):
+    target = "/httptest/splash.css"
+
+    def setUp(self):
+        self.processor = lib_helper.HTTPRequestProcessor(
+            "doc_root", use_sendfile=False, gzip_static=False, gzip_cache=http_gzip.GzipCache())
+        with open("doc_root" + self.target, "rb") as source:
+            self.source = source.read()
+
+    def test_get(self):
+        response = respond(self.processor, "GET", self.target, accept_encoding="gzip, deflate")
+        self.assertEqual("200", response.responsecode)
+        self.assertEqual(self.source, gzip.decompress(response.body))
+        self.assertEqual(len(response.body), response.headers['Content-Length'])
+        self.assertEqual("gzip", response.headers['Content-Encoding'])
+        self.assertEqual("Accept-Encoding", response.headers['Vary'])
+
+    def test_head(self):
+        get = respond(self.processor, "GET", self.target, accept_encoding="gzip")
+        head = respond(self.processor, "HEAD", self.target, accept_encoding="gzip")
+        self.assertEqual(get.headers, head.headers)
+        self.assertEqual(b"", head.body)
+        # Compressed once, for the GET
+        self.assertEqual(1, self.processor.gzip_cache.stats()['misses'])
+
+    def test_head_first(self):
+        head = respond(self.processor, "HEAD", self.target, accept_encoding="gzip")
+        self.assertEqual(b"", head.body)
+        get = respond(self.processor, "GET", self.target, accept_encoding="gzip")
+        self.assertEqual(len(get.body), head.headers['Content-Length'])
+
+    def test_range_uncompressed(self):
+        response = respond(self.processor, "GET", self.target, accept_encoding="gzip",
+                           range="bytes=0-99")
+        self.assertEqual("206", response.responsecode)
+        self.assertEqual(self.source[:100], response.body)
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_identity(self):
+        response = respond(self.processor, "GET", self.target)
+        # Streamed from the file
+        self.assertEqual(len(self.source), response.headers['Content-Length'])
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual("Accept-Encoding", response.headers['Vary'])
+
+
+class ErrorResponseTest(unittest.TestCase):
+    def setUp(self):
+        self.path_cache = http_cache.PathCache()
+        self.processor = lib_helper.HTTPRequestProcessor(
+            "doc_root", error_responses=lib_helper.ErrorResponseTable.default(),
+            path_cache=self.path_cache)
+
+    def respond(self, method, target):
+        return respond(self.processor, method, target)
+
+    def assert_head_of(self, get, head):
+        self.assertEqual(get.responsecode, head.responsecode)
+        self.assertTrue(get.body)
+        self.assertEqual(b"", head.body)
+        self.assertIn(b"Content-Length: %d\r\n" % len(get.body), head.head)
+
+    def test_head_not_found(self):
+        self.assert_head_of(self.respond("GET", "/httptest/missing.html"),
+                            self.respond("HEAD", "/httptest/missing.html"))
+        # Everything after the first GET is answered from the path cache
+        self.assert_head_of(self.respond("GET", "/httptest/missing.html"),
+                            self.respond("HEAD", "/httptest/missing.html"))
+        self.assertEqual(3, self.path_cache.negative_hits)
+
+    def test_head_forbidden(self):
+        self.assert_head_of(self.respond("GET", "/httptest/../../etc/passwd"),
+                            self.respond("HEAD", "/httptest/../../etc/passwd"))
+
+    def test_encoded_dot_segments(self):
+        target = "/%2e%2e/%2e%2e/%2e%2e/%2e%2e/%2e%2e/%2e%2e/etc/passwd"
+        self.assertEqual("403", self.respond("GET", target).responsecode)
+        self.assertEqual("403", self.path_cache.entries[target].responsecode)
+        self.assertEqual("403", self.respond("GET", "/httptest/%2E%2E%2f%2E%2E/").responsecode)
+        # Back inside the root
+        response = self.respond("GET", "/httptest/%2e%2e/httptest/dir2/page.html")
+        self.assertEqual("200", response.responsecode)
+        self.assertEqual("404", self.respond("GET", "/httptest/dir2/page.html/").responsecode)
+
+    def test_not_allowed(self):
+        response = self.respond("POST", "/httptest/dir2/page.html")
+        self.assertEqual("405", response.responsecode)
+        self.assertTrue(response.body)
+
+
+class AccessLogTest(unittest.TestCase):
+    def format(self, request):
+        access_log = http_log.AccessLog()
+        return list(access_log.format_batch([(0.0, ("127.0.0.1", 1), request, "200", 10, 0.001)]))
+
+    def test_header_cannot_forge_a_line(self):
+        user_agent = 'x"\n127.0.0.1 - - [01/Jan/2000:00:00:00 +0000] "GET / HTTP/1.1" 200 1 "-" "y'
+        request = http_parser.Request("GET", "/caf\xe9", "HTTP/1.1", {"user-agent": user_agent})
+        line, = self.format(request)
+        self.assertNotIn("\n", line)
+        self.assertIn('"GET /caf\\xe9 HTTP/1.1"', line)
+        self.assertIn('"x\\"\\x0a127.0.0.1', line)
+
+    def test_escape(self):
+        self.assertEqual("Mozilla/5.0 (X11)", http_log._escape("Mozilla/5.0 (X11)"))
+        self.assertEqual('a\\\\b\\"c\\x09\\x7f', http_log._escape('a\\b"c\t\x7f'))
+
+
+class ListenSocket:
+    """accept() returns or raises the queued results in turn."""
+
+    def __init__(self, *results):
+        self.results = list(results)
+
+    def accept(self):
+        if not self.results:
+            raise BlockingIOError(errno.EAGAIN, "drained")
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class AcceptTest(unittest.TestCase):
+    def setUp(self):
+        self.server = httpd.MultiprocessSocketServer(
+            "127.0.0.1", 0, 1, "doc_root", metrics_path=None)
+        self.server.worker_id = 0
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+
+    def connection(self):
+        sock = socket.socket()
+        self.sockets.append(sock)
+        return sock, ("127.0.0.1", len(self.sockets))
+
+    def test_failed_connections_are_skipped(self):
+        first, second = self.connection(), self.connection()
+        lsock = ListenSocket(ConnectionAbortedError(errno.ECONNABORTED, "aborted"), first,
+                             OSError(errno.EPROTO, "protocol error"),
+                             PermissionError(errno.EPERM, "refused"), second)
+        self.assertEqual([first, second], self.server.accept_connections(lsock))
+        self.assertEqual(2, self.server.connection_limit.open)
+
+    def test_accepted_connections_kept_on_error(self):
+        first = self.connection()
+        lsock = ListenSocket(first, OSError(errno.EINVAL, "invalid"))
+        self.assertEqual([first], self.server.accept_connections(lsock))
+        with self.assertRaises(OSError):
+            self.server.accept_connections(ListenSocket(OSError(errno.EINVAL, "invalid")))
+
+
+if __name__ == "__main__":
+    unittest.main()